@@ -0,0 +1,1387 @@
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import os
+import pty
+import random
+import re
+import resource
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+import aiohttp
+import requests
+import socketio
+
+# test3am opens chat.db relative to the working directory at import time, so
+# every benchmark runs against a scratch database in a temporary directory.
+TEST3AM = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test3am.py')
+sys.path.insert(0, os.path.dirname(TEST3AM))
+os.chdir(tempfile.mkdtemp(prefix='bench3am-'))
+
+import test3am
+from collections import Counter
+from difflib import get_close_matches
+from flask import render_template_string
+
+
+# Creates the user if needed; sessions must name an existing account.
+def logged_in_client(username='bench', is_admin=False):
+    with test3am.app.app_context():
+        db = test3am.get_db()
+        db.execute("INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, '')", (username,))
+        db.commit()
+        user_id = test3am.user_directory.user_id(db.cursor(), username)
+    client = test3am.app.test_client()
+    with client.session_transaction() as sess:
+        sess['username'] = username
+        sess['user_id'] = user_id
+        sess['is_admin'] = is_admin
+    return client
+
+
+def requests_per_second(client, method, path, duration, **kwargs):
+    count = 0
+    start = time.perf_counter()
+    deadline = start + duration
+    while time.perf_counter() < deadline:
+        getattr(client, method)(path, **kwargs)
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+def legacy_render_page(name, **context):
+    return render_template_string(test3am.TEMPLATES[name], **context)
+
+
+def bench_templates(args):
+    routes = [
+        ('index', 'get', '/', {}),
+        ('login', 'get', '/login', {}),
+        ('register', 'get', '/register', {}),
+        ('mp', 'get', '/mp', {}),
+        ('mp_search', 'post', '/mp', {'data': {'search_query': 'bench'}}),
+        ('mp_chat', 'get', '/mp/other', {}),
+    ]
+    # One client repeating the user search would be throttled after a burst.
+    test3am.app.config['RATE_LIMITS'] = False
+    # Streamed pages skip render_page, so both runs would time the same code.
+    test3am.app.config['STREAM_PAGES'] = False
+    # /mp/<username> answers 404 for users that do not exist.
+    with test3am.app.app_context():
+        db = test3am.get_db()
+        db.executemany("INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, '')",
+                       [('bench',), ('other',)])
+        db.commit()
+    client = logged_in_client()
+    registry_render_page = test3am.render_page
+    print('%-10s %12s %12s %8s' % ('route', 'before/s', 'after/s', 'speedup'))
+    for name, method, path, kwargs in routes:
+        test3am.render_page = legacy_render_page
+        before = requests_per_second(client, method, path, args.duration, **kwargs)
+        test3am.render_page = registry_render_page
+        after = requests_per_second(client, method, path, args.duration, **kwargs)
+        print('%-10s %12.1f %12.1f %7.2fx' % (name, before, after, after / before))
+
+
+def connect_socket(username):
+    flask_client = logged_in_client(username)
+    return test3am.socketio.test_client(test3am.app, flask_test_client=flask_client)
+
+
+def emits_per_second(emit, payload, duration):
+    count = 0
+    start = time.perf_counter()
+    deadline = start + duration
+    while time.perf_counter() < deadline:
+        emit(payload)
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+def legacy_emit_message(payload):
+    test3am.socketio.emit('message', payload)
+
+
+def bench_pageweight(args):
+    db = test3am.connect_db()
+    seed_messages(db, 1000, users=10)
+    client = logged_in_client('u1')
+    pages = [('login', 'get', '/login', {}), ('register', 'get', '/register', {}),
+             ('index', 'get', '/', {}), ('mp', 'get', '/mp', {}),
+             ('mp_search', 'post', '/mp', {'data': {'search_query': 'u2'}}),
+             ('mp_chat', 'get', '/mp/u2', {})]
+    encoding = 'br, gzip' if test3am.brotli else 'gzip'
+    print('Accept-Encoding: %s; assets from other hosts are not counted' % encoding)
+    print('%-10s %12s %12s %12s %12s' % ('page', 'html', 'inlined', 'first view', 'repeat view'))
+    for name, method, path, kwargs in pages:
+        html = getattr(client, method)(path, **kwargs).data
+        inline = first = len(html)
+        for url in re.findall(rb'(?:href|src)="(/assets/[^"]+)"', html):
+            # The same text inlined, uncompressed like the rest of the HTML.
+            # The old pages each inlined only their own rules, so this is an
+            # upper bound for them.
+            inline += len(client.get(url.decode()).data)
+            first += len(client.get(url.decode(), headers={'Accept-Encoding': encoding}).data)
+        # Repeat views only fetch the HTML; fingerprinted assets are cached
+        # as immutable.
+        print('%-10s %12d %12d %12d %12d' % (name, len(html), inline, first, len(html)))
+
+
+def bench_metrics(args):
+    with test3am.app.app_context():
+        seed_messages(test3am.get_db(), 100000, users=100)
+    client = logged_in_client('u1')
+    print('%-8s %10s %10s %10s %12s' % ('metrics', '/ req/s', '/mp req/s', 'mp_chat/s', 'query us'))
+    for enabled in (False, True):
+        test3am.app.config['METRICS'] = enabled
+        # Pooled connections keep the connection class they were opened with.
+        while not test3am.db_pool.empty():
+            test3am.db_pool.get().close()
+        db = test3am.connect_db()
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < args.duration:
+            db.execute("SELECT id, sender_id, message FROM messages WHERE id=?", (count % 1000 + 1,)).fetchall()
+            count += 1
+        query = (time.perf_counter() - start) / count * 1e6
+        db.close()
+        print('%-8s %10.1f %10.1f %10.1f %12.2f' % (
+            'on' if enabled else 'off', requests_per_second(client, 'get', '/', args.duration),
+            requests_per_second(client, 'get', '/mp', args.duration),
+            requests_per_second(client, 'get', '/mp/u2', args.duration), query))
+
+
+def bench_fanout(args):
+    payload = {'username': 'alice', 'message': 'hello', 'receiver': 'bob'}
+    sockets = [connect_socket('alice'), connect_socket('bob')]
+    print('%-8s %14s %14s' % ('idle', 'broadcast/s', 'rooms/s'))
+    for target in args.connections:
+        while len(sockets) < target + 2:
+            sockets.append(connect_socket('idle%d' % len(sockets)))
+        before = emits_per_second(legacy_emit_message, payload, args.duration)
+        for socket in sockets:
+            socket.get_received()
+        after = emits_per_second(test3am.emit_message, payload, args.duration)
+        for socket in sockets:
+            socket.get_received()
+        print('%-8d %14.1f %14.1f' % (target, before, after))
+
+
+def wire_bytes(packets):
+    # Socket.IO text frames as sent, plus the same frames through one
+    # permessage-deflate context with sync flushes, as a browser negotiates it.
+    deflate = zlib.compressobj(wbits=-15)
+    raw = compressed = 0
+    for packet in packets:
+        # The test client unwraps a lone dict argument.
+        arguments = packet['args'] if isinstance(packet['args'], list) else [packet['args']]
+        frame = ('4' + socketio.packet.Packet(socketio.packet.EVENT, [packet['name']] + arguments).encode()).encode()
+        raw += len(frame)
+        compressed += len(deflate.compress(frame) + deflate.flush(zlib.Z_SYNC_FLUSH)) - 4
+    return raw, compressed
+
+
+def bench_coalesce(args):
+    rate = args.message_rate
+    sockets = [connect_socket('u%d' % i) for i in range(args.active)]
+    print('%d sockets in the global room, %d messages/s' % (len(sockets), rate))
+    print('%-10s %10s %12s %12s %12s %12s' % ('interval', 'msgs/s', 'frames/s', 'msgs/frame',
+                                              'KB/s raw', 'KB/s deflate'))
+    for interval in args.intervals:
+        test3am.app.config['EMIT_COALESCE_INTERVAL'] = interval
+        for socket_client in sockets:
+            socket_client.get_received()
+        sent = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < args.duration:
+            test3am.emit_message({'id': sent + 1, 'username': 'u%d' % (sent % 1000),
+                                  'message': 'message %d' % sent, 'admin': False, 'receiver': 'all'})
+            sent += 1
+            delay = start + sent / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        elapsed = time.perf_counter() - start
+        time.sleep(max(interval * 2, 0.05))
+        # Every socket in the room gets the same frames; one is measured.
+        packets = sockets[0].get_received()
+        for socket_client in sockets[1:]:
+            socket_client.get_received()
+        received = sum(len(packet['args'][0]) if packet['name'] == 'messages' else 1 for packet in packets)
+        raw, compressed = wire_bytes(packets)
+        print('%-10s %10.1f %12.1f %12.1f %12.1f %12.1f' % (
+            interval or 'off', sent / elapsed, len(packets) / elapsed, received / max(len(packets), 1),
+            raw / elapsed / 1024, compressed / elapsed / 1024))
+
+
+def bench_presence(args):
+    sockets = [connect_socket('online%d' % i) for i in range(max(args.connections))]
+    print('%d sockets online' % len(sockets))
+    print('%-28s %14s %14s' % ('emit', 'always/s', 'skip offline/s'))
+    cases = [('DM, receiver online', {'username': 'online0', 'message': 'hello', 'receiver': 'online1'}),
+             ('DM, both offline', {'username': 'offline0', 'message': 'hello', 'receiver': 'offline1'})]
+    for name, payload in cases:
+        rates = []
+        for skip in (False, True):
+            test3am.app.config['PRESENCE_SKIP_OFFLINE'] = skip
+            rates.append(emits_per_second(test3am.emit_message, payload, args.duration))
+            for socket in sockets:
+                socket.get_received()
+        print('%-28s %14.1f %14.1f' % ((name,) + tuple(rates)))
+    sid = sockets[0].eio_sid
+    start = time.perf_counter()
+    for _ in range(100000):
+        test3am.presence.touch(test3am.socketio.server.manager.sid_from_eio_sid(sid, '/'))
+    print('heartbeat %.2f us' % ((time.perf_counter() - start) * 10))
+
+
+# Yields (sender, receiver, message, created) rows.
+def seed_rows(rows, users=1000, global_ratio=0.2, vocabulary=None):
+    rng = random.Random(3)
+    if vocabulary:
+        # Word frequencies fall off as 1/rank, as in natural text.
+        weights = list(itertools.accumulate(1 / rank for rank in range(1, len(vocabulary) + 1)))
+    # One message a second, ending now.
+    first = int(time.time()) - rows
+    for i in range(rows):
+        sender = 'u%d' % rng.randrange(users)
+        if rng.random() < global_ratio:
+            receiver = 'all'
+        else:
+            receiver = 'u%d' % rng.randrange(users)
+        if vocabulary:
+            message = ' '.join(rng.choices(vocabulary, cum_weights=weights, k=rng.randint(3, 12)))
+        else:
+            message = 'message %d' % i
+        yield sender, receiver, message, first + i
+
+
+def seed_messages(db, rows, users=1000, global_ratio=0.2, vocabulary=None):
+    db.executemany("INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, '')",
+                   [('u%d' % i,) for i in range(users)])
+    batch = []
+    for row in seed_rows(rows, users, global_ratio, vocabulary):
+        batch.append(row)
+        if len(batch) == 100000:
+            test3am.insert_messages(db, batch)
+            batch = []
+    test3am.insert_messages(db, batch)
+    db.commit()
+    test3am.user_directory.sync(db.cursor())
+
+
+def query_latency(query, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        rows = query()
+    return (time.perf_counter() - start) / repeat * 1000, len(rows)
+
+
+def bench_history(args):
+    with test3am.app.app_context():
+        db = test3am.get_db()
+        seed_messages(db, args.rows)
+        c = db.cursor()
+        c.execute("SELECT max(id) FROM messages")
+        middle = c.fetchone()[0] // 2
+        conversation = test3am.conversation_key('u1', 'u2')
+
+        u1, u2 = [test3am.user_directory.ids[name] for name in ('u1', 'u2')]
+        c.execute("DROP INDEX idx_messages_conversation")
+        c.execute("DROP INDEX idx_messages_receiver")
+        legacy = [
+            ('index full history', lambda: c.execute(
+                "SELECT sender_id, message FROM messages WHERE receiver_id IS NULL OR receiver_id=?", (u1,)).fetchall()),
+            ('mp_chat full history', lambda: c.execute(
+                '''SELECT sender_id, message FROM messages
+                   WHERE (sender_id=? AND receiver_id=?) OR (sender_id=? AND receiver_id=?)''',
+                (u1, u2, u2, u1)).fetchall()),
+        ]
+        print('%d rows' % args.rows)
+        print('%-28s %10s %8s' % ('query', 'ms', 'rows'))
+        for name, query in legacy:
+            print('%-28s %10.3f %8d' % ((name,) + query_latency(query, 3)))
+
+        test3am.migrate_messages_table()
+        paged = [
+            ('index latest page', lambda: test3am.fetch_inbox_page(c, 'u1')),
+            ('index page before middle', lambda: test3am.fetch_inbox_page(c, 'u1', middle)),
+            ('mp_chat latest page', lambda: test3am.fetch_conversation_page(c, conversation)),
+            ('mp_chat page before middle', lambda: test3am.fetch_conversation_page(c, conversation, middle)),
+        ]
+        for name, query in paged:
+            print('%-28s %10.3f %8d' % ((name,) + query_latency(query, 100)))
+
+
+def legacy_acquire_db():
+    return sqlite3.connect('legacy.db')
+
+
+def run_mixed_workload(acquire, release, readers, writers, duration):
+    counts = {'read': 0, 'write': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(kind):
+        done = 0
+        while time.perf_counter() < deadline:
+            db = acquire()
+            c = db.cursor()
+            if kind == 'read':
+                test3am.fetch_inbox_page(c, 'u%d' % random.randrange(1000), limit=50)
+            else:
+                test3am.insert_message(c, 'u1', 'all', 'bench')
+                db.commit()
+            release(db)
+            done += 1
+        with lock:
+            counts[kind] += done
+
+    threads = [threading.Thread(target=worker, args=('read',)) for _ in range(readers)]
+    threads += [threading.Thread(target=worker, args=('write',)) for _ in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts['read'] / duration, counts['write'] / duration
+
+
+def bench_pool(args):
+    with test3am.app.app_context():
+        seed_messages(test3am.get_db(), args.rows)
+    legacy = sqlite3.connect('legacy.db')
+    with test3am.app.app_context():
+        test3am.get_db().backup(legacy)
+    legacy.execute("PRAGMA journal_mode=DELETE")
+    legacy.close()
+
+    print('%d rows, %d readers, %d writers' % (args.rows, args.readers, args.writers))
+    print('%-22s %10s %10s' % ('connection layer', 'reads/s', 'writes/s'))
+    result = run_mixed_workload(legacy_acquire_db, lambda db: db.close(),
+                                args.readers, args.writers, args.duration)
+    print('%-22s %10.1f %10.1f' % (('connect per request',) + result))
+    result = run_mixed_workload(test3am.acquire_db, test3am.release_db,
+                                args.readers, args.writers, args.duration)
+    print('%-22s %10.1f %10.1f' % (('pooled WAL',) + result))
+
+
+def direct_write(sender, receiver, message):
+    db = test3am.acquire_db()
+    test3am.insert_message(db.cursor(), sender, receiver, message)
+    db.commit()
+    test3am.release_db(db)
+
+
+def queued_write(sender, receiver, message):
+    test3am.wait_for_write(test3am.queue_message(sender, receiver, message))
+
+
+def writes_per_second(write, senders, duration):
+    counts = []
+    deadline = time.perf_counter() + duration
+
+    def worker(sender):
+        done = 0
+        while time.perf_counter() < deadline:
+            write(sender, 'all', 'bench')
+            done += 1
+        counts.append(done)
+
+    threads = [threading.Thread(target=worker, args=('u%d' % i,)) for i in range(senders)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    test3am.flush_messages()
+    return sum(counts) / duration
+
+
+def bench_writes(args):
+    test3am.app.config['SQLITE_SYNCHRONOUS'] = args.synchronous
+    db = test3am.connect_db()
+    db.executemany("INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, '')",
+                   [('u%d' % i,) for i in range(args.senders)])
+    db.commit()
+    print('%d senders, synchronous=%s' % (args.senders, args.synchronous))
+    print('%-24s %10s %10s %12s' % ('write path', 'msgs/s', 'batch', 'flush ms'))
+    rate = writes_per_second(direct_write, args.senders, args.duration)
+    print('%-24s %10.1f %10s %12s' % ('insert + commit', rate, '1', '-'))
+    for durability in ('commit', 'async'):
+        test3am.app.config['WRITE_DURABILITY'] = durability
+        test3am.write_stats.update(batches=0, messages=0, max_batch_size=0,
+                                   flush_seconds=0.0, max_flush_seconds=0.0)
+        rate = writes_per_second(queued_write, args.senders, args.duration)
+        metrics = test3am.write_metrics()
+        print('%-24s %10.1f %10.1f %12.3f' % ('queued, ' + durability, rate, metrics['mean_batch_size'],
+                                              metrics['mean_flush_seconds'] * 1000))
+
+
+def bench_recent(args):
+    with test3am.app.app_context():
+        seed_messages(test3am.get_db(), args.rows)
+    test3am.recent_history.clear()
+    start = time.perf_counter()
+    test3am.warm_recent_history()
+    print('%d rows, warm load %.1f ms, %d buffers, %d messages cached' % (
+        args.rows, (time.perf_counter() - start) * 1000,
+        len(test3am.recent_history.buffers), test3am.recent_history.size))
+    client = logged_in_client('u1')
+    print('%-10s %12s %12s' % ('route', 'sqlite/s', 'cache/s'))
+    for name, path in (('index', '/'), ('mp_chat', '/mp/u2')):
+        test3am.app.config['HISTORY_CACHE'] = False
+        before = requests_per_second(client, 'get', path, args.duration)
+        test3am.app.config['HISTORY_CACHE'] = True
+        after = requests_per_second(client, 'get', path, args.duration)
+        print('%-10s %12.1f %12.1f' % (name, before, after))
+
+
+def logins_per_second(clients, duration):
+    counts = []
+    deadline = time.perf_counter() + duration
+
+    def worker(client):
+        done = 0
+        while time.perf_counter() < deadline:
+            client.post('/login', data={'username': 'bench', 'password': 'bench'})
+            done += 1
+        counts.append(done)
+
+    threads = [threading.Thread(target=worker, args=(client,)) for client in clients]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / (time.perf_counter() - start)
+
+
+def hashes_per_second(threads, duration):
+    stored = hashlib.sha256(b'bench').hexdigest()
+    counts = []
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        done = 0
+        while time.perf_counter() < deadline:
+            test3am.verify_password('bench', stored)
+            done += 1
+        counts.append(done)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return sum(counts) / (time.perf_counter() - start)
+
+
+def bench_logins(args):
+    cores = os.cpu_count() or 1
+    print('%d cores, %d hash workers, %d concurrent logins' % (
+        cores, test3am.app.config['PASSWORD_HASH_WORKERS'], args.senders))
+    print('%-34s %10s %14s' % ('password hash', 'logins/s', 'logins/s/core'))
+    clients = [test3am.app.test_client() for _ in range(args.senders)]
+    settings = [('sha256 (legacy)', None),
+                ('scrypt n=%d r=%d p=%d' % (test3am.app.config['SCRYPT_N'], test3am.app.config['SCRYPT_R'],
+                                            test3am.app.config['SCRYPT_P']), 'scrypt'),
+                ('pbkdf2_sha256 %d iterations' % test3am.app.config['PBKDF2_ITERATIONS'], 'pbkdf2_sha256')]
+    for name, kdf in settings:
+        with test3am.app.app_context():
+            db = test3am.get_db()
+            db.execute("DELETE FROM users WHERE username='bench'")
+            db.commit()
+            if kdf is None:
+                stored = hashlib.sha256(b'bench').hexdigest()
+            else:
+                test3am.app.config['PASSWORD_KDF'] = kdf
+                stored = test3am.hash_password('bench')
+            db.execute("INSERT INTO users (username, password_hash) VALUES ('bench', ?)", (stored,))
+            db.commit()
+        if kdf is None:
+            # Time the legacy check itself; a login would upgrade the row.
+            rate = hashes_per_second(args.senders, args.duration)
+        else:
+            rate = logins_per_second(clients, args.duration)
+        print('%-34s %10.1f %14.1f' % (name, rate, rate / min(cores, args.senders)))
+
+
+def syncs_per_second(socket_client, payload, duration):
+    count = 0
+    start = time.perf_counter()
+    deadline = start + duration
+    while time.perf_counter() < deadline:
+        socket_client.emit('sync', payload, callback=True)
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+def bench_sync(args):
+    # One socket syncing in a loop would soon be throttled.
+    test3am.app.config['RATE_LIMITS'] = False
+    with test3am.app.app_context():
+        seed_messages(test3am.get_db(), args.rows)
+        last_id = test3am.get_db().execute("SELECT max(id) FROM messages").fetchone()[0]
+    client = logged_in_client('u1')
+    socket_client = test3am.socketio.test_client(test3am.app, flask_test_client=client)
+    print('%d rows; a reconnecting client either reloads the page or syncs from its last id' % args.rows)
+    print('%-14s %10s %12s' % ('reconnect', 'bytes', 'per second'))
+    page = client.get('/').data
+    print('%-14s %10d %12.1f' % ('page reload', len(page), requests_per_second(client, 'get', '/', args.duration)))
+    for behind in (0, 1000, 10000):
+        payload = {'after': last_id - behind}
+        reply = socket_client.emit('sync', payload, callback=True)
+        size = len(test3am.socketio.server.packet_class(data=reply).encode())
+        print('%-14s %10d %12.1f' % ('sync -%d' % behind, size, syncs_per_second(socket_client, payload, args.duration)))
+    socket_client.disconnect()
+
+
+def bench_unread(args):
+    with test3am.app.app_context():
+        seed_messages(test3am.get_db(), args.rows)
+    start = time.perf_counter()
+    test3am.load_unread()
+    print('%d rows, rebuild %.1f ms, %d inboxes' % (
+        args.rows, (time.perf_counter() - start) * 1000, len(test3am.unread.inboxes)))
+    client = logged_in_client('u1')
+    print('%-10s %12s %12s' % ('route', 'sqlite/s', 'memory/s'))
+    for name, path in (('unread', '/unread'), ('index', '/')):
+        test3am.app.config['UNREAD_CACHE'] = False
+        before = requests_per_second(client, 'get', path, args.duration)
+        test3am.app.config['UNREAD_CACHE'] = True
+        after = requests_per_second(client, 'get', path, args.duration)
+        print('%-10s %12.1f %12.1f' % (name, before, after))
+
+
+def bench_retention(args):
+    db = test3am.connect_db()
+    seed_messages(db, args.rows)
+    conversation = test3am.conversation_key('u1', 'u2')
+    oldest = db.execute('''SELECT min(id) FROM messages
+                           WHERE conversation_id=(SELECT id FROM conversations WHERE key=?)''',
+                        (conversation,)).fetchone()[0]
+    pages = {'newest page': None, 'oldest page': oldest + 1}
+    print('%d rows, %d archived per tick' % (args.rows, test3am.app.config['RETENTION_BATCH']))
+    print('%-14s %12s %12s' % ('history', 'hot ms', 'archived ms'))
+    hot = {name: query_latency(lambda: test3am.fetch_conversation_page(db.cursor(), conversation, before), 20)[0]
+           for name, before in pages.items()}
+    size = test3am.database_size(db)
+
+    # Everything but the newest tenth expires.
+    test3am.app.config['RETENTION_AGE'] = args.rows // 10
+    ticks = []
+    while True:
+        start = time.perf_counter()
+        archived = test3am.archive_tick(db)
+        ticks.append(time.perf_counter() - start)
+        if archived < test3am.app.config['RETENTION_BATCH']:
+            break
+    for name, before in pages.items():
+        archived = query_latency(lambda: test3am.fetch_conversation_page(db.cursor(), conversation, before), 20)[0]
+        print('%-14s %12.3f %12.3f' % (name, hot[name], archived))
+    archive_bytes = db.execute("SELECT sum(length(payload)) FROM archive.segments").fetchone()[0]
+    print('%d ticks, mean %.1f ms, max %.1f ms' % (len(ticks), sum(ticks) / len(ticks) * 1000, max(ticks) * 1000))
+    print('chat.db %.1f MB -> %.1f MB, archive payload %.1f MB, %d rows left hot' % (
+        size / 1e6, test3am.database_size(db) / 1e6, archive_bytes / 1e6,
+        db.execute("SELECT count(*) FROM messages").fetchone()[0]))
+
+
+def bench_directory(args):
+    client = logged_in_client('u1')
+    directory = test3am.user_directory
+    print('%-10s %14s %12s %12s %12s %10s' % ('users', 'DISTINCT ms', 'count ms', 'page ms',
+                                               'exists ms', 'index/s'))
+    registered = 0
+    for count in args.users:
+        with test3am.app.app_context():
+            db = test3am.get_db()
+            # logged_in_client has already created u1.
+            db.executemany("INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, '')",
+                           [('u%d' % i,) for i in range(registered, count)])
+            db.commit()
+            registered = count
+            c = db.cursor()
+            directory.sync(c)
+            distinct = query_latency(lambda: c.execute("SELECT DISTINCT username FROM users").fetchall(),
+                                     args.queries)[0]
+            counted = query_latency(lambda: [directory.count(c)], args.queries)[0]
+            paged = query_latency(lambda: directory.page(c, 'u5'), args.queries)[0]
+            found = query_latency(lambda: [directory.exists(c, 'u%d' % (count // 2))], args.queries)[0]
+        print('%-10d %14.3f %12.4f %12.4f %12.4f %10.1f' % (
+            count, distinct, counted, paged, found, requests_per_second(client, 'get', '/', args.duration)))
+    print('hit rate %.3f' % directory.metrics()['hit_rate'])
+
+
+SYLLABLES = [consonant + vowel for consonant in 'bcdfghjklmnprstvwz' for vowel in 'aeiouy']
+
+
+def random_username(rng):
+    name = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+    return name + str(rng.randrange(100))
+
+
+def misspell(rng, name):
+    i = rng.randrange(len(name))
+    return name[:i] + rng.choice('aeiouxyz') + name[i + 1:]
+
+
+def bench_search(args):
+    rng = random.Random(7)
+    print('%-10s %10s %14s %14s %9s' % ('users', 'build ms', 'difflib ms', 'index ms', 'agree'))
+    for count in args.users:
+        names = list({random_username(rng) for _ in range(count)})
+        queries = [misspell(rng, rng.choice(names)) for _ in range(args.queries)]
+
+        index = test3am.UserSearchIndex()
+        start = time.perf_counter()
+        index.extend(names)
+        build = (time.perf_counter() - start) * 1000
+
+        legacy_queries = queries[:max(1, args.queries * 10000 // count)]
+        start = time.perf_counter()
+        expected = [get_close_matches(query, names, n=5, cutoff=0.8) for query in legacy_queries]
+        legacy = (time.perf_counter() - start) / len(legacy_queries) * 1000
+
+        start = time.perf_counter()
+        results = [index.fuzzy(query, 5, 0.8) for query in queries]
+        indexed = (time.perf_counter() - start) / len(queries) * 1000
+
+        agree = sum(result == match for result, match in zip(results, expected)) / len(expected)
+        print('%-10d %10.1f %14.3f %14.3f %8.0f%%' % (len(names), build, legacy, indexed, agree * 100))
+
+
+def bench_fulltext(args):
+    rng = random.Random(11)
+    vocabulary = set()
+    while len(vocabulary) < args.vocabulary:
+        vocabulary.add(random_username(rng).rstrip('0123456789'))
+    # Sorted first so the shuffle, and so the word ranks, do not depend on
+    # string hashing.
+    vocabulary = sorted(vocabulary)
+    rng.shuffle(vocabulary)
+    db = test3am.connect_db()
+    start = time.perf_counter()
+    seed_messages(db, args.rows, vocabulary=vocabulary)
+    print('%d rows indexed in %.1f s, %d words' % (args.rows, time.perf_counter() - start, len(vocabulary)))
+    queries = {
+        'common word': vocabulary[0],
+        'frequent word': vocabulary[100],
+        'rare word': vocabulary[-1],
+        'two words': '%s %s' % (vocabulary[10], vocabulary[200]),
+        'second page': vocabulary[0],
+    }
+    print('%-14s %10s %10s %10s %10s %10s' % ('query', 'matches', 'results', 'mean ms', 'p50 ms', 'p99 ms'))
+    c = db.cursor()
+    for name, text in queries.items():
+        offset = test3am.app.config['SEARCH_PAGE_SIZE'] if name == 'second page' else 0
+        matches = c.execute("SELECT count(*) FROM messages_fts WHERE messages_fts MATCH ?",
+                            (test3am.search_query(text),)).fetchone()[0]
+        results = test3am.search_messages(c, 'u1', text, offset)
+        samples = []
+        for _ in range(args.queries):
+            query_start = time.perf_counter()
+            test3am.search_messages(c, 'u%d' % rng.randrange(1000), text, offset)
+            samples.append(time.perf_counter() - query_start)
+        print('%-14s %10d %10d %10.3f %10.3f %10.3f' % ((name, matches, len(results)) + latency_summary(samples)))
+
+
+def bench_ratelimit(args):
+    print('%-10s %12s' % ('buckets', 'check us'))
+    for count in args.users:
+        limiter = test3am.RateLimiter('MESSAGE_RATE_LIMIT')
+        keys = ['u%d' % i for i in range(count)]
+        for key in keys:
+            limiter.take(key)
+        start = time.perf_counter()
+        for key in keys[:100000]:
+            limiter.take(key)
+        print('%-10d %12.3f' % (count, (time.perf_counter() - start) / min(count, 100000) * 1e6))
+
+    # One client posts as fast as it can while another keeps loading the
+    # chat page.
+    flooder = logged_in_client('flood')
+    reader = logged_in_client('u1')
+    limits = test3am.app.config['MESSAGE_RATE_LIMIT'], test3am.app.config['MESSAGE_IP_RATE_LIMIT']
+    print('%-10s %12s %12s %10s %10s' % ('limits', 'flood/s', 'stored/s', 'p50 ms', 'p99 ms'))
+    for name, limit in (('off', (1e9, 1e9)), ('on', None)):
+        test3am.app.config['MESSAGE_RATE_LIMIT'] = limit or limits[0]
+        test3am.app.config['MESSAGE_IP_RATE_LIMIT'] = limit or limits[1]
+        statuses = Counter()
+        done = threading.Event()
+
+        def flood():
+            while not done.is_set():
+                statuses[flooder.post('/', data={'message': 'spam', 'receiver': 'all'}).status_code] += 1
+
+        thread = threading.Thread(target=flood)
+        thread.start()
+        samples = []
+        deadline = time.perf_counter() + args.duration
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            reader.get('/')
+            samples.append(time.perf_counter() - start)
+        done.set()
+        thread.join()
+        print('%-10s %12.1f %12.1f %10.3f %10.3f' % (
+            name, sum(statuses.values()) / args.duration, statuses[204] / args.duration,
+            percentile(samples, 0.5) * 1000, percentile(samples, 0.99) * 1000))
+    print(test3am.rate_limiters['MESSAGE_RATE_LIMIT'].metrics())
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def latency_summary(samples):
+    return (sum(samples) / len(samples) * 1000, percentile(samples, 0.5) * 1000,
+            percentile(samples, 0.99) * 1000)
+
+
+class SilentJob:
+    def report(self, status, **details):
+        pass
+
+
+def write_latencies_during(task):
+    samples = []
+    done = threading.Event()
+
+    def writer():
+        while not done.is_set():
+            start = time.perf_counter()
+            queued_write('u1', 'all', 'bench')
+            samples.append(time.perf_counter() - start)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    start = time.perf_counter()
+    task()
+    elapsed = time.perf_counter() - start
+    done.set()
+    thread.join()
+    return elapsed, samples
+
+
+def bench_admin(args):
+    db = test3am.connect_db()
+    cutoff = int(time.time()) - args.rows // 2
+
+    def one_statement():
+        db.execute("DELETE FROM messages WHERE coalesce(created, 0)<?", (cutoff,))
+        db.commit()
+
+    def chunked():
+        test3am.delete_messages(db, SilentJob(), "coalesce(created, 0)<?", (cutoff,), stop_at_kept=True)
+
+    print('purging %d of %d rows while one sender keeps writing' % (args.rows // 2, args.rows))
+    print('%-16s %10s %10s %10s %10s' % ('purge', 'seconds', 'writes', 'p50 ms', 'max ms'))
+    for name, task in (('one statement', one_statement), ('chunked', chunked)):
+        db.execute("DELETE FROM messages")
+        seed_messages(db, args.rows)
+        elapsed, samples = write_latencies_during(task)
+        print('%-16s %10.2f %10d %10.3f %10.3f' % (name, elapsed, len(samples),
+                                                   percentile(samples, 0.5) * 1000, max(samples) * 1000))
+
+
+def bench_ingest(args):
+    # One sender in a tight loop, measuring the path rather than the throttle.
+    test3am.app.config['RATE_LIMITS'] = False
+    sender = logged_in_client('alice')
+    sender_socket = test3am.socketio.test_client(test3am.app, flask_test_client=sender)
+    receiver_socket = connect_socket('bob')
+
+    def http_send():
+        sender.post('/', data={'message': 'hello', 'receiver': 'bob'})
+
+    def socket_send():
+        sender_socket.emit('message', {'message': 'hello', 'receiver': 'bob'}, callback=True)
+
+    print('%-18s %10s %10s %10s' % ('path', 'mean ms', 'p50 ms', 'p99 ms'))
+    for name, send in (('http post', http_send), ('socket + ack', socket_send)):
+        samples = []
+        deadline = time.perf_counter() + args.duration
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            send()
+            samples.append(time.perf_counter() - start)
+            receiver_socket.get_received()
+        print('%-18s %10.3f %10.3f %10.3f' % ((name,) + latency_summary(samples)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def process_tree_rss(pid):
+    # Sums VmRSS over the server and its children (the development server
+    # runs the app in a reloader child).
+    pids = {pid}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/%s/stat' % entry) as stat:
+                    if int(stat.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        pids.add(int(entry))
+            except OSError:
+                pass
+    total = 0
+    for child in pids:
+        try:
+            with open('/proc/%d/status' % child) as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+def start_server(async_mode, extra_args=(), workdir=None, env=None):
+    port = free_port()
+    workdir = workdir or tempfile.mkdtemp(prefix='bench3am-server-')
+    # Flask-SocketIO refuses to start the Werkzeug development server (the
+    # threading mode) without a terminal on stdin.
+    master, terminal = pty.openpty()
+    server = subprocess.Popen([sys.executable, TEST3AM, '--async-mode', async_mode, '--port', str(port)]
+                              + list(extra_args), cwd=workdir, stdin=terminal, env=dict(os.environ, **(env or {})),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    os.close(terminal)
+    url = 'http://127.0.0.1:%d' % port
+    # Warming the caches of a seeded database takes a while.
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            requests.get(url + '/login', timeout=1)
+            return server, url
+        except requests.RequestException:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError('server did not start on %s' % url)
+
+
+def register_user(url, username):
+    http = requests.Session()
+    http.post(url + '/register', data={'username': username, 'password': 'bench'}, allow_redirects=False)
+    return 'session=' + http.cookies['session']
+
+
+async def open_sockets(url, cookies, count, clients):
+    async def connect(i):
+        client = socketio.AsyncClient(reconnection=False)
+        try:
+            await client.connect(url, headers={'Cookie': cookies[i % len(cookies)]},
+                                 transports=['websocket'], wait_timeout=30)
+        except socketio.exceptions.ConnectionError:
+            return None
+        return client
+
+    start = time.perf_counter()
+    opened = []
+    for batch in range(len(clients), count, 100):
+        results = await asyncio.gather(*[connect(i) for i in range(batch, min(batch + 100, count))])
+        opened.extend(results)
+    clients.extend(opened)
+    return time.perf_counter() - start, sum(client is None for client in opened)
+
+
+async def drive_active(clients, active, duration):
+    samples = []
+    deadline = time.perf_counter() + duration
+
+    async def sender(client):
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            await client.call('message', {'message': 'bench', 'receiver': 'bench0'}, timeout=30)
+            samples.append(time.perf_counter() - start)
+
+    await asyncio.gather(*[sender(client) for client in clients[:active]])
+    return samples
+
+
+async def scale_connections(url, cookies, args):
+    clients = []
+    print('%-8s %10s %8s %10s %10s %10s %10s' % ('sockets', 'connect s', 'failed', 'rss MB',
+                                                 'msgs/s', 'p50 ms', 'p99 ms'))
+    for target in args.connections:
+        elapsed, failed = await open_sockets(url, cookies, target, clients)
+        connected = [client for client in clients if client is not None]
+        await asyncio.sleep(1)
+        rss = process_tree_rss(args.server.pid) / 1024 / 1024
+        samples = await drive_active(connected, min(args.active, len(connected)), args.duration)
+        print('%-8d %10.2f %8d %10.1f %10.1f %10.3f %10.3f' % (
+            len(connected), elapsed, failed, rss, len(samples) / args.duration,
+            percentile(samples, 0.5) * 1000, percentile(samples, 0.99) * 1000))
+    for client in clients:
+        if client is not None:
+            await client.disconnect()
+
+
+def bench_connections(args):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    # Every client connects from 127.0.0.1, so the address limits would
+    # throttle the whole run.
+    args.server, url = start_server(args.async_mode, env={'CHAT_RATE_LIMITS': 'off'})
+    try:
+        cookies = [register_user(url, 'bench%d' % i) for i in range(args.bench_users)]
+        print('async mode %s, %d users, %d active senders' % (args.async_mode, args.bench_users, args.active))
+        asyncio.run(scale_connections(url, cookies, args))
+    finally:
+        args.server.terminate()
+        args.server.wait()
+
+
+async def drive_workers(port, cookies, args):
+    clients = []
+    received = []
+    for i in range(args.active):
+        # Spreading clients over loopback addresses spreads them over the
+        # workers, which are picked by client address.
+        client = socketio.AsyncClient(reconnection=False)
+        client.on('message', lambda data: received.append(data))
+        await client.connect('http://127.0.0.%d:%d' % (i % 250 + 1, port),
+                             headers={'Cookie': cookies[i % len(cookies)]}, transports=['websocket'])
+        clients.append(client)
+    samples = await drive_active(clients, len(clients), args.duration)
+    await asyncio.sleep(0.5)
+    for client in clients:
+        await client.disconnect()
+    return samples, len(received)
+
+
+def bench_workers(args):
+    print('%d senders, message queue %s' % (args.active, args.message_queue))
+    print('%-8s %10s %12s %10s %10s' % ('workers', 'msgs/s', 'delivered/s', 'p50 ms', 'p99 ms'))
+    for workers in args.worker_counts:
+        server, url = start_server('eventlet', ['--host', '0.0.0.0', '--workers', str(workers),
+                                                '--message-queue', args.message_queue],
+                                   env={'CHAT_RATE_LIMITS': 'off'})
+        try:
+            cookies = [register_user(url, 'bench%d' % i) for i in range(args.bench_users)]
+            port = int(url.rsplit(':', 1)[1])
+            samples, delivered = asyncio.run(drive_workers(port, cookies, args))
+        finally:
+            server.terminate()
+            server.wait()
+        print('%-8d %10.1f %12.1f %10.3f %10.3f' % (
+            workers, len(samples) / args.duration, delivered / args.duration,
+            percentile(samples, 0.5) * 1000, percentile(samples, 0.99) * 1000))
+
+
+# Relative weights of what a simulated user does next.
+LOAD_MIX = {
+    'socket_post': 30,
+    'http_post': 10,
+    'dm_post': 10,
+    'index': 10,
+    'history': 20,
+    'mp_chat': 10,
+    'mp_search': 10,
+}
+
+
+class LoadUser:
+    def __init__(self, url, username, args, results, deliveries):
+        self.url = url
+        self.username = username
+        self.args = args
+        self.results = results
+        self.deliveries = deliveries
+        self.rng = random.Random(username)
+        self.http = None
+        self.socket = None
+
+    async def login(self):
+        self.http = aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True))
+        async with self.http.post(self.url + '/login', data={'username': self.username, 'password': 'bench'},
+                                  allow_redirects=False) as response:
+            if response.status != 302:
+                raise RuntimeError('login failed for %s: %d' % (self.username, response.status))
+        cookie = '; '.join('%s=%s' % (name, morsel.value)
+                           for name, morsel in self.http.cookie_jar.filter_cookies(self.url).items())
+        self.socket = socketio.AsyncClient(reconnection=False)
+        self.socket.on('message', self.delivered)
+        self.socket.on('messages', lambda batch: [self.delivered({'message': record[2]}) for record in batch])
+        await self.socket.connect(self.url, headers={'Cookie': cookie}, transports=['websocket'], wait_timeout=30)
+
+    # Posted messages carry their send time, so every receiver can tell how
+    # long delivery took.
+    def delivered(self, data):
+        if data['message'].startswith('load '):
+            self.deliveries.append(time.time() - float(data['message'].split()[1]))
+
+    def other_user(self):
+        return 'u%d' % self.rng.randrange(self.args.seed_users)
+
+    async def http_request(self, method, path, **kwargs):
+        async with self.http.request(method, self.url + path, allow_redirects=False, **kwargs) as response:
+            await response.read()
+            return response.status < 400
+
+    async def act(self, action):
+        message = 'load %r' % time.time()
+        if action == 'socket_post':
+            ack = await self.socket.call('message', {'message': message, 'receiver': 'all'}, timeout=30)
+            return bool(ack and ack.get('id'))
+        if action == 'http_post':
+            return await self.http_request('POST', '/', data={'message': message, 'receiver': 'all'})
+        if action == 'dm_post':
+            return await self.http_request('POST', '/mp/' + self.other_user(), data={'message': message})
+        if action == 'index':
+            return await self.http_request('GET', '/')
+        if action == 'history':
+            before = self.rng.randrange(1, self.args.seed_messages + 1)
+            return await self.http_request('GET', '/history?before=%d' % before)
+        if action == 'mp_chat':
+            return await self.http_request('GET', '/mp/' + self.other_user())
+        return await self.http_request('POST', '/mp', data={'search_query': self.other_user()})
+
+    async def run(self, deadline):
+        actions = list(LOAD_MIX)
+        weights = list(LOAD_MIX.values())
+        while time.perf_counter() < deadline:
+            action = self.rng.choices(actions, weights)[0]
+            start = time.perf_counter()
+            try:
+                ok = await self.act(action)
+            except (aiohttp.ClientError, asyncio.TimeoutError, socketio.exceptions.SocketIOError):
+                ok = False
+            self.results[action].append((time.perf_counter() - start, ok))
+            if self.args.think:
+                await asyncio.sleep(self.rng.expovariate(1 / self.args.think))
+
+    async def close(self):
+        if self.socket is not None:
+            await self.socket.disconnect()
+        if self.http is not None:
+            await self.http.close()
+
+
+async def drive_load(url, args):
+    results = {action: [] for action in LOAD_MIX}
+    deliveries = []
+    users = [LoadUser(url, 'u%d' % i, args, results, deliveries) for i in range(args.clients)]
+    await asyncio.gather(*[user.login() for user in users])
+    start = time.perf_counter()
+    await asyncio.gather(*[user.run(start + args.duration) for user in users])
+    elapsed = time.perf_counter() - start
+    # Let the last messages arrive.
+    await asyncio.sleep(1)
+    for user in users:
+        await user.close()
+    return results, deliveries, elapsed
+
+
+def latency_report(samples):
+    if not samples:
+        return {'count': 0}
+    return {'count': len(samples), 'p50_ms': percentile(samples, 0.5) * 1000,
+            'p99_ms': percentile(samples, 0.99) * 1000, 'max_ms': max(samples) * 1000}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(TEST3AM),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def peak_rss():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+
+
+# Runs one page request in a forked child, so the peak RSS it reports is that
+# request's alone: clear_refs resets the high-water mark to the current RSS.
+def page_cost(path, stream):
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        test3am.app.config['STREAM_PAGES'] = stream
+        client = logged_in_client('u1')
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        baseline = peak_rss()
+        start = time.perf_counter()
+        response = client.get(path, buffered=False)
+        body = iter(response.response)
+        size = len(next(body))
+        first_byte = time.perf_counter() - start
+        size += sum(len(chunk) for chunk in body)
+        total = time.perf_counter() - start
+        response.close()
+        os.write(write, json.dumps([first_byte, total, size, peak_rss() - baseline]).encode())
+        os._exit(0)
+    os.close(write)
+    with os.fdopen(read) as f:
+        result = json.loads(f.read())
+    os.waitpid(pid, 0)
+    return result
+
+
+def bench_streaming(args):
+    first = int(time.time()) - args.seed_messages
+    with test3am.app.app_context():
+        db = test3am.get_db()
+        db.executemany("INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, '')", [('u1',), ('u2',)])
+        test3am.insert_messages(db, [('u%d' % (i % 2 + 1), 'u%d' % (2 - i % 2), 'message %d' % i, first + i)
+                                     for i in range(args.seed_messages)])
+        db.commit()
+        test3am.user_directory.sync(db.cursor())
+    # The children must not share the parent's SQLite connections.
+    while not test3am.db_pool.empty():
+        test3am.db_pool.get().close()
+    page_size = test3am.app.config['HISTORY_PAGE_SIZE']
+    # The whole conversation on one page.
+    test3am.app.config['HISTORY_PAGE_SIZE'] = args.seed_messages
+    print('/mp/u2 with %d messages' % args.seed_messages)
+    for stream in (False, True):
+        first_byte, total, size, peak = page_cost('/mp/u2', stream)
+        print('  %-8s first byte %7.1f ms  complete %7.1f ms  %6.1f MB  peak RSS +%6.1f MB'
+              % ('stream' if stream else 'buffered', first_byte * 1000, total * 1000, size / 1e6, peak / 1e6))
+    # In process there is no TCP, and so none of the stalls small writes can
+    # run into; a server on the default page size shows what a browser sees.
+    with test3am.app.app_context():
+        db = test3am.get_db()
+        db.execute("UPDATE users SET password_hash=? WHERE username='u1'", (test3am.hash_password('bench'),))
+        db.commit()
+    while not test3am.db_pool.empty():
+        test3am.db_pool.get().close()
+    print('over TCP, %s, %d messages a page' % (args.async_mode, page_size))
+    for stream in ('off', 'on'):
+        server, url = start_server(args.async_mode, workdir=os.getcwd(),
+                                   env={'CHAT_STREAM_PAGES': stream, 'CHAT_RATE_LIMITS': 'off'})
+        try:
+            http = requests.Session()
+            http.post(url + '/login', data={'username': 'u1', 'password': 'bench'}, allow_redirects=False)
+            for path in ('/', '/mp/u2'):
+                samples = []
+                for i in range(100):
+                    start = time.perf_counter()
+                    http.get(url + path)
+                    samples.append(time.perf_counter() - start)
+                print('  %-8s %-8s p50 %7.1f ms  p99 %7.1f ms' % (
+                    'stream' if stream == 'on' else 'buffered', path,
+                    percentile(samples, 0.5) * 1000, percentile(samples, 0.99) * 1000))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+# The messages table before it referenced users and conversations by id, with
+# usernames and conversation keys stored as text, and its history queries.
+LEGACY_MESSAGES_SCHEMA = '''
+CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, sender TEXT, receiver TEXT,
+                       message TEXT, conversation TEXT, created INTEGER);
+CREATE INDEX idx_messages_conversation ON messages (conversation, id);
+CREATE INDEX idx_messages_receiver ON messages (receiver, id);
+'''
+
+LEGACY_CONVERSATION_PAGE = '''SELECT id, sender, message FROM messages
+                              WHERE conversation=? AND id<?
+                              ORDER BY id DESC LIMIT ?'''
+
+LEGACY_INBOX_PAGE = '''SELECT id, sender, message FROM (
+                           SELECT id, sender, message FROM messages
+                           WHERE conversation='all' AND id<? ORDER BY id DESC LIMIT ?)
+                       UNION ALL
+                       SELECT id, sender, message FROM (
+                           SELECT id, sender, message FROM messages
+                           WHERE receiver=? AND receiver!='all' AND id<? ORDER BY id DESC LIMIT ?)
+                       ORDER BY id DESC LIMIT ?'''
+
+
+def schema_sizes(db):
+    db.execute("VACUUM")
+    sizes = {'chat.db': test3am.database_size(db)}
+    for name in ('messages', 'idx_messages_conversation', 'idx_messages_receiver'):
+        sizes[name] = db.execute("SELECT sum(pgsize) FROM dbstat WHERE name=?", (name,)).fetchone()[0]
+    return sizes
+
+
+def bench_schema(args):
+    db = test3am.connect_db()
+    db.executescript("DROP TABLE messages;" + LEGACY_MESSAGES_SCHEMA)
+    # 100 users, so that conversations run to more than a page each, as they
+    # do between real users; a conversations row per message or two would
+    # cost more than the ids save.
+    db.executemany("INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, '')",
+                   [('u%d' % i,) for i in range(100)])
+    db.executemany("INSERT INTO messages (sender, receiver, message, conversation, created) VALUES (?, ?, ?, ?, ?)",
+                   ((sender, receiver, message, test3am.conversation_key(sender, receiver), created)
+                    for sender, receiver, message, created in seed_rows(args.rows, users=100)))
+    db.commit()
+    middle = db.execute("SELECT max(id) FROM messages").fetchone()[0] // 2
+    conversation = test3am.conversation_key('u1', 'u2')
+    limit = test3am.app.config['HISTORY_PAGE_SIZE']
+    queries = [
+        ('mp_chat latest page', lambda: db.execute(LEGACY_CONVERSATION_PAGE, (conversation, test3am.HISTORY_END, limit)),
+         lambda: test3am.fetch_conversation_page(db.cursor(), conversation)),
+        ('mp_chat page before middle', lambda: db.execute(LEGACY_CONVERSATION_PAGE, (conversation, middle, limit)),
+         lambda: test3am.fetch_conversation_page(db.cursor(), conversation, middle)),
+        ('index latest page', lambda: db.execute(LEGACY_INBOX_PAGE, (test3am.HISTORY_END, limit, 'u1',
+                                                                     test3am.HISTORY_END, limit, limit)),
+         lambda: test3am.fetch_inbox_page(db.cursor(), 'u1')),
+        ('index page before middle', lambda: db.execute(LEGACY_INBOX_PAGE, (middle, limit, 'u1', middle, limit, limit)),
+         lambda: test3am.fetch_inbox_page(db.cursor(), 'u1', middle)),
+    ]
+    before = schema_sizes(db)
+    legacy = [query_latency(lambda: old().fetchall(), 200)[0] for name, old, new in queries]
+
+    start = time.perf_counter()
+    test3am.migrate_messages_table()
+    migration = time.perf_counter() - start
+    after = schema_sizes(db)
+    current = [query_latency(new, 200)[0] for name, old, new in queries]
+
+    print('%d rows, migrated in %.1f s (%d rows per batch)' % (
+        args.rows, migration, test3am.app.config['MIGRATION_BATCH_SIZE']))
+    print('%-28s %12s %12s' % ('', 'text', 'integer ids'))
+    for name in before:
+        print('%-28s %9.1f MB %9.1f MB' % (name, before[name] / 1e6, after[name] / 1e6))
+    for (name, old, new), old_ms, new_ms in zip(queries, legacy, current):
+        print('%-28s %9.3f ms %9.3f ms' % (name, old_ms, new_ms))
+
+
+# Runs the server on a freshly seeded scratch database and drives it with
+# simulated users, each logged in over HTTP with its own socket. The report is
+# JSON so that runs on different commits can be compared.
+def bench_load(args):
+    if args.clients > args.seed_users:
+        sys.exit('--clients cannot exceed --seed-users')
+    with test3am.app.app_context():
+        db = test3am.get_db()
+        seed_messages(db, args.seed_messages, users=args.seed_users)
+        # Every seeded user logs in with the password 'bench'.
+        db.execute("UPDATE users SET password_hash=?", (test3am.hash_password('bench'),))
+        db.commit()
+    while not test3am.db_pool.empty():
+        test3am.db_pool.get().close()
+    env = {} if args.rate_limits else {'CHAT_RATE_LIMITS': 'off'}
+    server, url = start_server(args.async_mode, workdir=os.getcwd(), env=env)
+    try:
+        results, deliveries, elapsed = asyncio.run(drive_load(url, args))
+    finally:
+        server.terminate()
+        server.wait()
+    report = {
+        'revision': git_revision(),
+        'async_mode': args.async_mode,
+        'clients': args.clients,
+        'seed_users': args.seed_users,
+        'seed_messages': args.seed_messages,
+        'duration': elapsed,
+        'requests_per_second': sum(len(samples) for samples in results.values()) / elapsed,
+        'actions': {},
+        'delivery': latency_report(deliveries),
+    }
+    for action, samples in results.items():
+        report['actions'][action] = dict(latency_report([seconds for seconds, ok in samples]),
+                                         per_second=len(samples) / elapsed,
+                                         errors=sum(not ok for seconds, ok in samples))
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+BENCHMARKS = {
+    'templates': bench_templates,
+    'pageweight': bench_pageweight,
+    'metrics': bench_metrics,
+    'fanout': bench_fanout,
+    'presence': bench_presence,
+    'coalesce': bench_coalesce,
+    'history': bench_history,
+    'pool': bench_pool,
+    'writes': bench_writes,
+    'recent': bench_recent,
+    'sync': bench_sync,
+    'unread': bench_unread,
+    'retention': bench_retention,
+    'logins': bench_logins,
+    'search': bench_search,
+    'fulltext': bench_fulltext,
+    'ratelimit': bench_ratelimit,
+    'directory': bench_directory,
+    'admin': bench_admin,
+    'ingest': bench_ingest,
+    'connections': bench_connections,
+    'workers': bench_workers,
+    'load': bench_load,
+    'streaming': bench_streaming,
+    'schema': bench_schema,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for test3am.')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--duration', type=float, default=2.0,
+                        help='seconds to run each measurement')
+    parser.add_argument('--connections', type=int, nargs='+', default=[10, 100, 1000],
+                        help='socket counts for the fanout and connections benchmarks')
+    parser.add_argument('--rows', type=int, default=1000000,
+                        help='messages to seed for the history, pool, recent, fulltext and schema benchmarks')
+    parser.add_argument('--readers', type=int, default=16,
+                        help='reader threads for the pool benchmark')
+    parser.add_argument('--writers', type=int, default=2,
+                        help='writer threads for the pool benchmark')
+    parser.add_argument('--senders', type=int, default=32,
+                        help='concurrent senders for the writes and logins benchmarks')
+    parser.add_argument('--synchronous', default='FULL',
+                        help='SQLite synchronous pragma for the writes benchmark')
+    parser.add_argument('--users', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='user counts for the search, directory and ratelimit benchmarks')
+    parser.add_argument('--queries', type=int, default=50,
+                        help='lookups per case in the search and fulltext benchmarks')
+    parser.add_argument('--message-rate', type=int, default=1000,
+                        help='messages per second emitted in the coalesce benchmark')
+    parser.add_argument('--intervals', type=float, nargs='+', default=[0, 0.005, 0.02, 0.1],
+                        help='EMIT_COALESCE_INTERVAL values for the coalesce benchmark')
+    parser.add_argument('--vocabulary', type=int, default=50000,
+                        help='distinct words in the messages seeded by the fulltext benchmark')
+    parser.add_argument('--async-mode', default='eventlet', choices=['threading', 'eventlet', 'gevent'],
+                        help='server worker model for the connections benchmark')
+    parser.add_argument('--active', type=int, default=20,
+                        help='sockets sending messages in the connections benchmark, listening in the coalesce one')
+    parser.add_argument('--bench-users', type=int, default=50,
+                        help='users the connections and workers benchmarks spread their sockets over')
+    parser.add_argument('--worker-counts', type=int, nargs='+', default=[1, 2, 4],
+                        help='worker process counts for the workers benchmark')
+    parser.add_argument('--message-queue', default='sqlite:///chat-bus.db',
+                        help='message queue URL for the workers benchmark')
+    parser.add_argument('--clients', type=int, default=50,
+                        help='simulated users in the load benchmark')
+    parser.add_argument('--seed-users', type=int, default=1000,
+                        help='users seeded for the load benchmark')
+    parser.add_argument('--seed-messages', type=int, default=100000,
+                        help='messages seeded for the load and streaming benchmarks')
+    parser.add_argument('--think', type=float, default=0,
+                        help='mean pause between the actions of a simulated user, in seconds')
+    parser.add_argument('--rate-limits', action='store_true',
+                        help='keep the rate limits on in the load benchmark')
+    parser.add_argument('--output', help='file to write the load benchmark report to')
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,490 @@
+import argparse
+import os
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Chat server.')
+    parser.add_argument('--async-mode', choices=['threading', 'eventlet', 'gevent'],
+                        default=os.environ.get('CHAT_ASYNC_MODE', 'threading'),
+                        help='worker model; threading runs the development server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes sharing the port (eventlet only)')
+    parser.add_argument('--message-queue', default=os.environ.get('CHAT_MESSAGE_QUEUE'),
+                        help='pub/sub URL shared by the workers, e.g. redis://localhost:6379 '
+                             'or sqlite:///chat-bus.db')
+    parser.add_argument('--worker-fd', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.workers > 1 and args.async_mode != 'eventlet':
+        parser.error('--workers needs --async-mode eventlet')
+    return args
+
+# eventlet and gevent have to patch the standard library before anything else
+# uses it, so the worker model is settled before the remaining imports.
+run_args = parse_args() if __name__ == '__main__' else None
+ASYNC_MODE = run_args.async_mode if run_args else os.environ.get('CHAT_ASYNC_MODE', 'threading')
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+    import eventlet.tpool
+    eventlet.monkey_patch()
+elif ASYNC_MODE == 'gevent':
+    import gevent
+    from gevent import monkey
+    monkey.patch_all()
+
+import bisect
+import datetime
+import gzip
 import hashlib
+import heapq
+import hmac
+import itertools
+import json
+import math
+import mimetypes
+import queue
 import random
+import re
+import signal
+import socket
 import sqlite3
-from flask import Flask, render_template_string, request, g, redirect, url_for, session
-from flask_socketio import SocketIO, emit
-from difflib import get_close_matches
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict, deque
+from flask import Flask, render_template, request, g, redirect, url_for, session, jsonify, Response, stream_with_context
+from flask_socketio import SocketIO, emit, join_room
+import socketio as socketio_server
+from difflib import SequenceMatcher, get_close_matches
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret!'
-socketio = SocketIO(app)
+app.config['PRERENDER_STATIC_PAGES'] = True
+app.config['ASSET_MAX_AGE'] = 365 * 24 * 3600
+# The Socket.IO client, vendored into the static folder. Without the file,
+# pages load the same version from the CDN.
+app.config['SOCKETIO_CLIENT'] = 'socket.io.min.js'
+app.config['SOCKETIO_CLIENT_CDN'] = 'https://cdnjs.cloudflare.com/ajax/libs/socket.io/4.8.1/socket.io.min.js'
+app.config['HISTORY_PAGE_SIZE'] = 50
+app.config['HISTORY_SYNC_LIMIT'] = 500
+# Chat pages can be sent as they render, in chunks of about STREAM_CHUNK_SIZE
+# characters, so the head and the first messages go out before the rest of
+# the history has been read. That only pays off for pages far longer than the
+# default HISTORY_PAGE_SIZE, which fit in one chunk and are sent sooner whole.
+# CHAT_STREAM_PAGES=on turns it on.
+app.config['STREAM_PAGES'] = os.environ.get('CHAT_STREAM_PAGES', 'off') == 'on'
+app.config['STREAM_CHUNK_SIZE'] = 16384
+app.config['DATABASE'] = 'chat.db'
+app.config['SQLITE_POOL_SIZE'] = 16
+app.config['SQLITE_STATEMENT_CACHE'] = 256
+app.config['SQLITE_SYNCHRONOUS'] = 'NORMAL'
+app.config['SQLITE_CACHE_SIZE'] = -16000
+app.config['SQLITE_MMAP_SIZE'] = 256 * 1024 * 1024
+app.config['SQLITE_BUSY_TIMEOUT'] = 5000
+app.config['WRITE_BATCH_SIZE'] = 256
+app.config['WRITE_BATCH_INTERVAL'] = 0.001
+# 'commit' makes message POSTs wait for their batch to be committed;
+# 'async' returns as soon as the message is queued and emitted.
+app.config['WRITE_DURABILITY'] = 'commit'
+# A worker process would not see messages written by its siblings in its own
+# buffers, so the history cache is only used by a single server process.
+app.config['HISTORY_CACHE'] = not (run_args and run_args.worker_fd is not None)
+app.config['UNREAD_CACHE'] = app.config['HISTORY_CACHE']
+app.config['HISTORY_CACHE_DEPTH'] = 50
+app.config['HISTORY_CACHE_MAX_MESSAGES'] = 200000
+app.config['HISTORY_CACHE_MAX_BUFFERS'] = 20000
+app.config['HISTORY_CACHE_WARM_CONVERSATIONS'] = 1000
+# Rows per transaction when init_database upgrades an old messages table.
+app.config['MIGRATION_BATCH_SIZE'] = 20000
+app.config['SQLITE_THREADS'] = 16
+# Request, query, render and emit timings for GET /metrics. Queries slower
+# than SLOW_QUERY_SECONDS are also logged.
+app.config['METRICS'] = True
+app.config['SLOW_QUERY_SECONDS'] = 0.1
+# Lets a scraper without an admin session read /metrics with
+# 'Authorization: Bearer <token>'.
+app.config['METRICS_TOKEN'] = os.environ.get('CHAT_METRICS_TOKEN')
+app.config['MESSAGE_QUEUE'] = run_args.message_queue if run_args else os.environ.get('CHAT_MESSAGE_QUEUE')
+if run_args and run_args.workers > 1 and not app.config['MESSAGE_QUEUE']:
+    app.config['MESSAGE_QUEUE'] = 'sqlite:///chat-bus.db'
+app.config['BUS_POLL_INTERVAL'] = 0.005
+app.config['BUS_RETENTION'] = 60
+# With a non-zero interval, outbound chat messages are buffered for that many
+# seconds and sent to each room as one 'messages' event of compact records
+# instead of one 'message' event each. Off by default; busy global channels
+# benefit most. Either way, compression is whatever permessage-deflate the
+# websocket handshake negotiated (browsers offer it, both servers accept it).
+app.config['EMIT_COALESCE_INTERVAL'] = 0
+app.config['EMIT_BATCH_MAX'] = 500
+app.config['PRESENCE_HEARTBEAT'] = 25
+app.config['PRESENCE_TIMEOUT'] = 75
+app.config['PRESENCE_SWEEP_INTERVAL'] = 15
+app.config['ONLINE_LIST_SIZE'] = 50
+# Presence only sees the sockets of its own process, so with a message queue
+# between workers every emit still goes out.
+app.config['PRESENCE_SKIP_OFFLINE'] = not app.config['MESSAGE_QUEUE']
+app.config['USER_DIRECTORY_REFRESH'] = 5.0
+app.config['USER_PAGE_SIZE'] = 100
+# Messages older than RETENTION_AGE seconds move to compressed segments in
+# ARCHIVE_DATABASE, RETENTION_BATCH rows per tick; by default the archive sits
+# next to DATABASE, chat-archive.db beside chat.db. Archived messages stay on
+# the history pages but are no longer found by search, so retention is off
+# (None) until an age is set. Messages from before timestamps were stored are
+# dated at the schema upgrade, so they stay in the messages table, searchable,
+# for RETENTION_AGE after it instead of being archived on the first ticks; the
+# price is that a purge dated before the upgrade does not reach them.
+app.config['ARCHIVE_DATABASE'] = None
+app.config['RETENTION_AGE'] = None
+app.config['RETENTION_BATCH'] = 1000
+app.config['RETENTION_INTERVAL'] = 60
+app.config['RETENTION_PAUSE'] = 0.1
+app.config['RETENTION_VACUUM_PAGES'] = 1000
+app.config['ARCHIVE_SEGMENT_CACHE'] = 64
+# Search ranks the newest SEARCH_CANDIDATES visible matches by relevance, so a
+# query on a very common word costs the same on any size of history.
+app.config['SEARCH_PAGE_SIZE'] = 20
+app.config['SEARCH_CANDIDATES'] = 1000
+# Token buckets as (tokens per second, burst), per session user and per client
+# address. The address limits are looser since several users can share one.
+# Searches cover both the user search on /mp and /search; syncs are the
+# catch-up a socket asks for on every connect, a page of messages at a time.
+# CHAT_RATE_LIMITS=off turns them all off, for load tests from a single
+# address.
+app.config['RATE_LIMITS'] = os.environ.get('CHAT_RATE_LIMITS', 'on') != 'off'
+app.config['MESSAGE_RATE_LIMIT'] = (2.0, 20)
+app.config['MESSAGE_IP_RATE_LIMIT'] = (10.0, 100)
+app.config['SEARCH_RATE_LIMIT'] = (1.0, 10)
+app.config['SEARCH_IP_RATE_LIMIT'] = (5.0, 50)
+app.config['SYNC_RATE_LIMIT'] = (2.0, 30)
+app.config['SYNC_IP_RATE_LIMIT'] = (10.0, 150)
+# Admin bulk deletes commit every ADMIN_CHUNK_SIZE ids and then pause, so
+# chat writes are never held up for long.
+app.config['ADMIN_CHUNK_SIZE'] = 10000
+app.config['ADMIN_CHUNK_PAUSE'] = 0.01
+# 'scrypt' or 'pbkdf2_sha256'. Stored hashes carry their own parameters, so
+# changing these upgrades each account on its next login.
+app.config['PASSWORD_KDF'] = 'scrypt'
+app.config['SCRYPT_N'] = 2 ** 14
+app.config['SCRYPT_R'] = 8
+app.config['SCRYPT_P'] = 1
+app.config['PBKDF2_ITERATIONS'] = 600000
+app.config['PASSWORD_HASH_WORKERS'] = os.cpu_count() or 1
+
+GREEN_MODES = ('eventlet', 'gevent')
+
+def run_blocking(func, *args, **kwargs):
+    if ASYNC_MODE == 'eventlet':
+        return eventlet.tpool.execute(func, *args, **kwargs)
+    if ASYNC_MODE == 'gevent':
+        return gevent.get_hub().threadpool.apply(func, args, kwargs)
+    return func(*args, **kwargs)
+
+def configure_threadpool():
+    if ASYNC_MODE == 'eventlet':
+        eventlet.tpool.set_num_threads(app.config['SQLITE_THREADS'])
+    elif ASYNC_MODE == 'gevent':
+        gevent.get_hub().threadpool.maxsize = app.config['SQLITE_THREADS']
+
+configure_threadpool()
+
+# Wraps a sqlite3 connection or cursor so that every call runs on a real OS
+# thread through run_blocking; under eventlet/gevent a slow query then parks
+# only the calling greenlet instead of the whole hub.
+class BlockingProxy:
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            result = run_blocking(attr, *args, **kwargs)
+            if isinstance(result, (sqlite3.Connection, sqlite3.Cursor)):
+                return BlockingProxy(result)
+            return result
+        return call
+
+    def __iter__(self):
+        while True:
+            rows = run_blocking(self._target.fetchmany, 256)
+            if not rows:
+                return
+            yield from rows
+
+# Cross-process pub/sub for Socket.IO on a shared SQLite file, for running
+# several workers on one machine without a broker. Messages are rows in a WAL
+# database that every listener polls by id.
+class SQLiteBusManager(socketio_server.PubSubManager):
+    name = 'sqlite'
+
+    def __init__(self, url, channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = url[len('sqlite:///'):]
+        self.lock = threading.Lock()
+        self.db = self.open_bus()
+        self.published = 0
+
+    def open_bus(self):
+        db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=OFF")
+        db.execute("PRAGMA busy_timeout=%d" % app.config['SQLITE_BUSY_TIMEOUT'])
+        db.execute('''CREATE TABLE IF NOT EXISTS bus
+                      (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       channel TEXT,
+                       created REAL,
+                       payload TEXT)''')
+        return db
+
+    def write(self, payload):
+        now = time.time()
+        self.db.execute("INSERT INTO bus (channel, created, payload) VALUES (?, ?, ?)",
+                        (self.channel, now, payload))
+        self.published += 1
+        if self.published % 1000 == 0:
+            self.db.execute("DELETE FROM bus WHERE created<?", (now - app.config['BUS_RETENTION'],))
+
+    def _publish(self, data):
+        # The lock is taken on the caller's side: under eventlet and gevent it
+        # is a green lock, which cannot be acquired from a threadpool thread.
+        payload = self.json.dumps(data)
+        with self.lock:
+            run_blocking(self.write, payload)
+
+    def read(self, db, last_id):
+        return db.execute("SELECT id, payload FROM bus WHERE channel=? AND id>? ORDER BY id",
+                          (self.channel, last_id)).fetchall()
+
+    def _listen(self):
+        db = self.open_bus()
+        last_id = db.execute("SELECT coalesce(max(id), 0) FROM bus").fetchone()[0]
+        while True:
+            rows = run_blocking(self.read, db, last_id)
+            for last_id, payload in rows:
+                yield payload
+            if not rows:
+                self.server.sleep(app.config['BUS_POLL_INTERVAL'])
+
+def create_socketio():
+    url = app.config['MESSAGE_QUEUE']
+    if url and url.startswith('sqlite:'):
+        return SocketIO(app, async_mode=ASYNC_MODE, client_manager=SQLiteBusManager(url))
+    return SocketIO(app, async_mode=ASYNC_MODE, message_queue=url)
+
+socketio = create_socketio()
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+# Histograms and counters keyed by metric name and a tuple of (label, value)
+# pairs. Recording is a dict lookup and a bisect under a lock, cheap enough
+# to leave on.
+class Metrics:
+    def __init__(self):
+        self.histograms = {}
+        self.counters = Counter()
+        # Statement label -> [executions, seconds], and the histogram of all
+        # SQLite calls; queries are frequent enough to get one lock each.
+        self.statements = {}
+        self.queries = Histogram()
+        self.lock = threading.Lock()
+
+    def observe(self, name, labels, seconds):
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = Histogram()
+            histogram.observe(seconds)
+
+    def inc(self, name, labels=(), amount=1):
+        with self.lock:
+            self.counters[(name, labels)] += amount
+
+    def query(self, statement, seconds, executed):
+        with self.lock:
+            self.queries.observe(seconds)
+            stats = self.statements.get(statement)
+            if stats is None:
+                stats = self.statements[statement] = [0, 0.0]
+            stats[0] += executed
+            stats[1] += seconds
+
+    def snapshot(self):
+        with self.lock:
+            histograms = [(name, labels, list(histogram.counts), histogram.sum)
+                          for (name, labels), histogram in self.histograms.items()]
+            histograms.append(('chat_sqlite_query_duration_seconds', (), list(self.queries.counts), self.queries.sum))
+            counters = dict(self.counters)
+            for statement, (executed, seconds) in self.statements.items():
+                counters[('chat_sqlite_statements_total', (('statement', statement),))] = executed
+                counters[('chat_sqlite_statement_seconds_total', (('statement', statement),))] = seconds
+            return histograms, counters
+
+metrics = Metrics()
+
+# Normalized statement text, used as the query label. Statements built with
+# a variable number of placeholders would each get a label, so the table is
+# capped and anything past it is counted as 'other'.
+statement_labels = {}
+
+def statement_label(sql):
+    label = statement_labels.get(sql)
+    if label is None:
+        label = ' '.join(sql.split())
+        if len(statement_labels) >= 500:
+            return 'other'
+        statement_labels[sql] = label
+    return label
+
+def record_query(sql, seconds, executed=True):
+    statement = statement_label(sql)
+    metrics.query(statement, seconds, executed)
+    if seconds >= app.config['SLOW_QUERY_SECONDS']:
+        metrics.inc('chat_sqlite_slow_queries_total')
+        app.logger.warning('Slow query (%.1f ms): %s', seconds * 1000, statement)
+
+# Connection and cursor classes that time every statement. Rows of a SELECT
+# are mostly produced while fetching, so fetches are timed too and added to
+# the statement that produced them.
+class TimedCursor(sqlite3.Cursor):
+    statement = ''
+
+    def execute(self, sql, parameters=()):
+        self.statement = sql
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.statement = sql
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(sql, time.perf_counter() - start)
+
+    def executescript(self, sql_script):
+        self.statement = sql_script
+        start = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            record_query(sql_script, time.perf_counter() - start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        record_query(self.statement, time.perf_counter() - start, executed=False)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        record_query(self.statement, time.perf_counter() - start, executed=False)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        record_query(self.statement, time.perf_counter() - start, executed=False)
+        return rows
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    # The built-in shortcuts run the statement without going through the
+    # cursor's Python methods.
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            record_query('COMMIT', time.perf_counter() - start)
+
+# Idle connections, most recently used first. Connections are checked out
+# for the duration of an app context and handed back on teardown, so threads
+# and greenlets share a small set of warm connections and statement caches.
+db_pool = queue.LifoQueue()
+
+def archive_database():
+    if app.config['ARCHIVE_DATABASE']:
+        return app.config['ARCHIVE_DATABASE']
+    root, ext = os.path.splitext(app.config['DATABASE'])
+    return root + '-archive' + (ext or '.db')
+
+def connect_db():
+    factory = TimedConnection if app.config['METRICS'] else sqlite3.Connection
+    db = run_blocking(sqlite3.connect, app.config['DATABASE'], check_same_thread=False,
+                      cached_statements=app.config['SQLITE_STATEMENT_CACHE'], factory=factory)
+    if ASYNC_MODE in GREEN_MODES:
+        db = BlockingProxy(db)
+    # Lets the retention engine hand freed pages back a few at a time. It only
+    # takes on a database that is still empty, so it has to come before WAL;
+    # the admin vacuum command converts an existing one.
+    db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=%s" % app.config['SQLITE_SYNCHRONOUS'])
+    db.execute("PRAGMA cache_size=%d" % app.config['SQLITE_CACHE_SIZE'])
+    db.execute("PRAGMA mmap_size=%d" % app.config['SQLITE_MMAP_SIZE'])
+    db.execute("PRAGMA busy_timeout=%d" % app.config['SQLITE_BUSY_TIMEOUT'])
+    db.execute("ATTACH DATABASE ? AS archive", (archive_database(),))
+    db.execute("PRAGMA archive.journal_mode=WAL")
+    return db
+
+def acquire_db():
+    try:
+        return db_pool.get_nowait()
+    except queue.Empty:
+        return connect_db()
+
+def release_db(db):
+    if db.in_transaction:
+        db.rollback()
+    if db_pool.qsize() < app.config['SQLITE_POOL_SIZE']:
+        db_pool.put(db)
+    else:
+        db.close()
 
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect('chat.db')
+        db = g._database = acquire_db()
     return db
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
+    db = g.pop('_database', None)
     if db is not None:
-        db.close()
+        release_db(db)
 
 def create_users_table():
     with app.app_context():
@@ -32,23 +497,2391 @@ def create_users_table():
                       is_admin INTEGER DEFAULT 0)''')
         db.commit()
 
+# Messages refer to users and conversations by id. receiver_id is NULL on
+# the global channel; conversations maps each conversation key ('all' or the
+# two usernames, see conversation_key) to its id. created is in Unix seconds.
+MESSAGES_SCHEMA = '''(id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      sender_id INTEGER NOT NULL,
+                      receiver_id INTEGER,
+                      conversation_id INTEGER NOT NULL,
+                      created INTEGER,
+                      message TEXT)'''
+
 def create_messages_table():
     with app.app_context():
         db = get_db()
         c = db.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS messages
+        c.execute('''CREATE TABLE IF NOT EXISTS conversations
+                     (id INTEGER PRIMARY KEY,
+                      key TEXT UNIQUE)''')
+        c.execute("CREATE TABLE IF NOT EXISTS messages " + MESSAGES_SCHEMA)
+        db.commit()
+
+def migrate_messages_table():
+    with app.app_context():
+        db = get_db()
+        c = db.cursor()
+        c.execute("PRAGMA table_info(messages)")
+        columns = [row[1] for row in c.fetchall()]
+        if 'sender' in columns:
+            upgrade_messages_table(db, columns)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (conversation_id, id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_messages_receiver ON messages (receiver_id, id)")
+        db.commit()
+
+# Converts a messages table that stores usernames as text. Rows are copied
+# into messages_upgrade MIGRATION_BATCH_SIZE at a time, each batch in its own
+# short transaction, and a restart carries on after the last copied id. The
+# batch that finds no more rows swaps the tables. Ids are kept, so read marks,
+# the archive and the full-text index stay valid. Usernames with messages but
+# no account get one nobody can log in to.
+def upgrade_messages_table(db, columns):
+    conversation = '''CASE WHEN receiver IS NULL OR receiver='all' THEN 'all'
+                           WHEN sender<receiver THEN sender || char(31) || receiver
+                           ELSE receiver || char(31) || sender END'''
+    if 'conversation' in columns:
+        conversation = 'coalesce(conversation, %s)' % conversation
+    # Rows from before the created column get the time of the upgrade; see
+    # RETENTION_AGE.
+    created = str(int(time.time()))
+    if 'created' in columns:
+        created = 'coalesce(created, %s)' % created
+    batch_size = app.config['MIGRATION_BATCH_SIZE']
+    c = db.cursor()
+    c.execute("CREATE TABLE IF NOT EXISTS messages_upgrade " + MESSAGES_SCHEMA)
+    db.commit()
+    c.execute("SELECT coalesce(max(id), 0) FROM messages_upgrade")
+    copied = c.fetchone()[0]
+    while True:
+        c.execute("BEGIN IMMEDIATE")
+        # Another worker process may have finished the upgrade meanwhile.
+        c.execute("PRAGMA table_info(messages)")
+        if 'sender' not in [row[1] for row in c.fetchall()]:
+            db.rollback()
+            return
+        c.execute('''SELECT id, sender, receiver, message, %s, %s FROM messages
+                     WHERE id>? ORDER BY id LIMIT ?''' % (conversation, created), (copied, batch_size))
+        rows = c.fetchall()
+        names = {(name,) for row in rows for name in row[1:3] if name not in (None, 'all')}
+        c.executemany("INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, '')", names)
+        c.executemany("INSERT OR IGNORE INTO conversations (key) VALUES (?)", {(row[4],) for row in rows})
+        c.executemany('''INSERT OR IGNORE INTO messages_upgrade
+                         (id, sender_id, receiver_id, conversation_id, created, message)
+                         VALUES (?, (SELECT id FROM users WHERE username=?), (SELECT id FROM users WHERE username=?),
+                                 (SELECT id FROM conversations WHERE key=?), ?, ?)''',
+                      [(id, sender, None if receiver == 'all' else receiver, key, created, message)
+                       for id, sender, receiver, message, key, created in rows])
+        if len(rows) < batch_size:
+            # Ids deleted from the end of the old table are not handed out again.
+            c.execute('''UPDATE sqlite_sequence
+                         SET seq=max(seq, (SELECT seq FROM sqlite_sequence WHERE name='messages'))
+                         WHERE name='messages_upgrade' ''')
+            c.execute("DROP TABLE messages")
+            c.execute("ALTER TABLE messages_upgrade RENAME TO messages")
+            db.commit()
+            return
+        db.commit()
+        copied = rows[-1][0]
+
+# Last message id each user has read per conversation. When the table is
+# first created every existing conversation counts as read, so upgrading does
+# not flood inboxes with old messages.
+def create_read_marks_table():
+    with app.app_context():
+        db = get_db()
+        c = db.cursor()
+        c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='read_marks'")
+        if c.fetchone():
+            return
+        c.execute('''CREATE TABLE read_marks
+                     (username TEXT,
+                      conversation TEXT,
+                      last_read_id INTEGER,
+                      PRIMARY KEY (username, conversation))''')
+        c.execute('''INSERT INTO read_marks (username, conversation, last_read_id)
+                     SELECT u.username, k.key, max(m.id) FROM messages m
+                     JOIN users u ON u.id=m.receiver_id
+                     JOIN conversations k ON k.id=m.conversation_id
+                     GROUP BY m.receiver_id, m.conversation_id''')
+        db.commit()
+
+# Archived messages live in segments of up to RETENTION_BATCH consecutive
+# rows, stored as zlib-compressed JSON. segment_keys lists, for every
+# conversation key and every 'inbox:<receiver>' present in a segment, the id
+# range it covers there, so history pages only open the segments they need.
+def create_archive_tables():
+    with app.app_context():
+        db = get_db()
+        c = db.cursor()
+        c.execute('''CREATE TABLE IF NOT EXISTS archive.segments
                      (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      sender TEXT,
-                      receiver TEXT,
-                      message TEXT)''')
+                      first_id INTEGER,
+                      last_id INTEGER,
+                      payload BLOB)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS archive.segment_keys
+                     (key TEXT,
+                      first_id INTEGER,
+                      last_id INTEGER,
+                      segment_id INTEGER,
+                      PRIMARY KEY (key, last_id, segment_id))''')
+        db.commit()
+
+# Full-text index over message bodies. It reads the text from messages
+# itself and is kept in step by triggers, so every write path (the batched
+# writer, admin deletes, retention) updates it; archived messages leave the
+# index along with the hot table. An existing history is indexed when the
+# table is first created.
+def create_message_search_table():
+    with app.app_context():
+        db = get_db()
+        c = db.cursor()
+        c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='messages_fts'")
+        exists = c.fetchone()
+        try:
+            c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+                         USING fts5(message, content='messages', content_rowid='id')''')
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5.
+            app.config['MESSAGE_SEARCH'] = False
+            return
+        c.execute('''CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+                         INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+                     END''')
+        c.execute('''CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+                         INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+                     END''')
+        c.execute('''CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message ON messages BEGIN
+                         INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+                         INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+                     END''')
+        if not exists:
+            c.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
         db.commit()
+        app.config['MESSAGE_SEARCH'] = True
 
 def init_database():
     create_users_table()
     create_messages_table()
+    migrate_messages_table()
+    create_read_marks_table()
+    create_archive_tables()
+    create_message_search_table()
 
 init_database()
 
+INDEX_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="fr">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Chat</title>
+    <link rel="stylesheet" href="{{ asset_url('chat.css') }}">
+</head>
+<body data-username="{{ session.username }}" data-heartbeat="{{ config.PRESENCE_HEARTBEAT * 1000 }}" data-unread="{{ unread_total }}">
+    <div class="header">
+        <div>
+            <input id="search-input" class="message-search" type="search" placeholder="Search messages...">
+        </div>
+        <div>
+            <span>Welcome, {{ session.username }}</span>
+            <a href="/logout">Logout</a>
+            <a href="/mp">MP<span id="unread-total">{% if unread_total %} ({{ unread_total }}){% endif %}</span></a>
+        </div>
+    </div>
+    {% if session.get('is_admin') %}
+    <div class="admin-controls">
+        <input id="admin-command-input" class="admin-command-input" placeholder="Enter command...">
+        <button id="admin-command-button" class="admin-command-button" onclick="sendAdminCommand()">Send</button>
+        <pre id="admin-output" class="admin-output"></pre>
+    </div>
+    {% endif %}
+    <div class="chat-container">
+        <div id="search-results" class="search-results"></div>
+        {% if messages %}
+        <button id="load-older" class="load-older" data-url="/history">Load older messages</button>
+        {% endif %}
+        <div id="chat-messages" class="chat-messages">
+            {% for id, sender, message in messages %}
+            <div class="message" data-id="{{ id }}">
+                <span class="username">{{ sender }}: </span>
+                <span class="content">{{ message }}</span>
+            </div>
+            {% endfor %}
+        </div>
+        <form id="message-form" method="post">
+            <input id="receiver" type="hidden" name="receiver" value="all">
+            <input id="message-input" class="message-input" name="message" placeholder="Type your message...">
+            <button id="send-button" class="send-button" type="submit">Send</button>
+        </form>
+    </div>
+
+    <script src="{{ asset_url('socket.io.js') }}"></script>
+    <script src="{{ asset_url('chat.js') }}"></script>
+</body>
+</html>
+"""
+
+LOGIN_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="fr">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Login</title>
+    <link rel="stylesheet" href="{{ asset_url('chat.css') }}">
+</head>
+<body>
+    <div class="login-container">
+        <h2>Login</h2>
+        <form method="post">
+            <input class="login-input" type="text" name="username" placeholder="Username" required>
+            <input class="login-input" type="password" name="password" placeholder="Password" required>
+            <button class="login-button" type="submit">Login</button>
+        </form>
+        <a class="register-link" href="/register">Register</a>
+    </div>
+</body>
+</html>
+"""
+
+REGISTER_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="fr">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Register</title>
+    <link rel="stylesheet" href="{{ asset_url('chat.css') }}">
+</head>
+<body>
+    <div class="register-container">
+        <h2>Register</h2>
+        <form method="post">
+            <input class="register-input" type="text" name="username" placeholder="Username" required>
+            <input class="register-input" type="password" name="password" placeholder="Password" required>
+            <button class="register-button" type="submit">Register</button>
+        </form>
+        <a class="login-link" href="/login">Login</a>
+    </div>
+</body>
+</html>
+"""
+
+MP_SEARCH_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="fr">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Search Users</title>
+    <link rel="stylesheet" href="{{ asset_url('chat.css') }}">
+</head>
+<body>
+    <div class="search-container">
+        <h2>Search Users</h2>
+        <form method="post">
+            <input class="search-input" type="text" name="search_query" placeholder="Search users..." required>
+            <button class="search-button" type="submit">Search</button>
+        </form>
+        <ul class="user-list">
+            {% for user, is_online in matched_users %}
+            <li class="user-item">
+                <a class="user-link" href="{{ url_for('mp_chat', username=user) }}">{{ user }}</a>
+                {% if is_online %}<span class="online-dot" title="Online"></span>{% endif %}
+            </li>
+            {% endfor %}
+        </ul>
+        <div class="online">
+            <h3 id="online-count">Online</h3>
+            <ul id="online-users" class="user-list"></ul>
+        </div>
+    </div>
+    <script src="{{ asset_url('users.js') }}"></script>
+</body>
+</html>
+"""
+
+MP_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="fr">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Search Users</title>
+    <link rel="stylesheet" href="{{ asset_url('chat.css') }}">
+</head>
+<body>
+    <div class="search-container">
+        <h2>Search Users</h2>
+        <form method="post">
+            <input class="search-input" type="text" name="search_query" placeholder="Search users..." required>
+            <button class="search-button" type="submit">Search</button>
+        </form>
+        <div id="unread" class="unread" hidden>
+            <h3>Unread</h3>
+            <ul id="unread-conversations" class="user-list"></ul>
+        </div>
+        <div class="online">
+            <h3 id="online-count">Online</h3>
+            <ul id="online-users" class="user-list"></ul>
+        </div>
+    </div>
+    <script src="{{ asset_url('users.js') }}"></script>
+</body>
+</html>
+"""
+
+MP_CHAT_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="fr">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>MP with {{ username }}</title>
+    <link rel="stylesheet" href="{{ asset_url('chat.css') }}">
+</head>
+<body data-username="{{ session.username }}" data-partner="{{ username }}" data-heartbeat="{{ config.PRESENCE_HEARTBEAT * 1000 }}">
+    <div class="chat-container">
+        <h2>Chat with {{ username }}</h2>
+        {% if messages %}
+        <button id="load-older" class="load-older" data-url="{{ url_for('mp_history', username=username) }}">Load older messages</button>
+        {% endif %}
+        <div id="chat-messages" class="chat-messages">
+            {% for id, sender, message in messages %}
+            <div class="message" data-id="{{ id }}">
+                <span class="username">{{ sender }}: </span>
+                <span class="content">{{ message }}</span>
+            </div>
+            {% endfor %}
+        </div>
+        <form id="message-form" method="post">
+            <input id="receiver" type="hidden" name="receiver" value="{{ username }}">
+            <input id="message-input" class="message-input" name="message" placeholder="Type your message...">
+            <button id="send-button" class="send-button" type="submit">Send</button>
+        </form>
+    </div>
+
+    <script src="{{ asset_url('socket.io.js') }}"></script>
+    <script src="{{ asset_url('chat.js') }}"></script>
+</body>
+</html>
+"""
+
+CHAT_CSS = """
+body {
+    background-color: #282c34;
+    font-family: 'Roboto', sans-serif;
+    color: white;
+    margin: 0;
+    padding: 0;
+    display: flex;
+    justify-content: center;
+    align-items: center;
+    height: 100vh;
+}
+.header {
+    width: 100%;
+    display: flex;
+    justify-content: space-between;
+    align-items: center;
+    padding: 10px 20px;
+    background-color: #1c1e22;
+    position: fixed;
+    top: 0;
+    z-index: 1000;
+}
+.header a {
+    color: white;
+    text-decoration: none;
+    padding: 5px 10px;
+    border: 1px solid transparent;
+    border-radius: 5px;
+}
+.header a:hover {
+    background-color: rgba(255, 255, 255, 0.1);
+}
+.chat-container {
+    background-color: #3c4048;
+    border-radius: 10px;
+    box-shadow: 0px 0px 10px 0px rgba(0, 0, 0, 0.1);
+    margin: 80px 20px;
+    max-width: 800px;
+    width: 100%;
+    padding: 20px;
+}
+.message-input {
+    border-radius: 5px;
+    border: 1px solid #ccc;
+    font-size: 16px;
+    margin-bottom: 10px;
+    padding: 10px;
+    width: calc(100% - 20px);
+}
+.send-button {
+    background-color: #4caf50;
+    border: none;
+    border-radius: 5px;
+    color: white;
+    cursor: pointer;
+    font-size: 16px;
+    padding: 10px 20px;
+    margin-left: 10px;
+}
+.send-button:hover {
+    background-color: #45a049;
+}
+.message {
+    background-color: #525760;
+    border-radius: 5px;
+    margin-bottom: 5px;
+    padding: 10px;
+}
+.username {
+    font-weight: bold;
+}
+.content {
+    margin-left: 5px;
+}
+.message-error {
+    opacity: 0.5;
+}
+.load-older {
+    background: none;
+    border: none;
+    color: #61dafb;
+    cursor: pointer;
+    display: block;
+    font-size: 14px;
+    margin: 0 auto 10px;
+}
+.admin-message {
+    color: #f00;
+}
+.admin-controls {
+    position: fixed;
+    top: 50px;
+    right: 20px;
+    padding: 10px
+    background-color: #1c1e22;
+    border-radius: 5px;
+    box-shadow: 0 2px 5px rgba(0, 0, 0, 0.1);
+    z-index: 1000;
+}
+.admin-command-input {
+    border: none;
+    border-radius: 3px;
+    padding: 8px;
+    margin-right: 5px;
+    font-size: 14px;
+    width: 200px;
+}
+.admin-command-button {
+    background-color: #4caf50;
+    border: none;
+    border-radius: 3px;
+    color: white;
+    cursor: pointer;
+    font-size: 14px;
+    padding: 8px 12px;
+}
+.admin-command-button:hover {
+    background-color: #45a049;
+}
+.admin-output {
+    font-size: 12px;
+    margin: 5px 0 0;
+    max-height: 300px;
+    max-width: 320px;
+    overflow: auto;
+}
+.message-search {
+    border: none;
+    border-radius: 3px;
+    font-size: 14px;
+    padding: 6px;
+    width: 200px;
+}
+.search-results {
+    border-bottom: 1px solid #525760;
+    margin-bottom: 10px;
+}
+.search-results:empty {
+    display: none;
+}
+.delete-button {
+    background-color: #ff0000;
+    border: none;
+    border-radius: 3px;
+    color: white;
+    cursor: pointer;
+    font-size: 14px;
+    padding: 8px 12px;
+}
+.delete-button:hover {
+    background-color: #c00000;
+}
+.login-container {
+    background-color: #3c4048;
+    border-radius: 10px;
+    box-shadow: 0px 0px 10px 0px rgba(0, 0, 0, 0.1);
+    max-width: 400px;
+    width: 100%;
+    padding: 20px;
+    text-align: center;
+}
+.login-input {
+    border-radius: 5px;
+    border: 1px solid #ccc;
+    font-size: 16px;
+    margin-bottom: 10px;
+    padding: 10px;
+    width: calc(100% - 20px);
+}
+.login-button {
+    background-color: #4caf50;
+    border: none;
+    border-radius: 5px;
+    color: white;
+    cursor: pointer;
+    font-size: 16px;
+    padding: 10px 20px;
+    width: 100%;
+}
+.login-button:hover {
+    background-color: #45a049;
+}
+.register-link {
+    color: #61dafb;
+    display: block;
+    margin-top: 20px;
+    text-decoration: none;
+}
+.register-link:hover {
+    text-decoration: underline;
+}
+.register-container {
+    background-color: #3c4048;
+    border-radius: 10px;
+    box-shadow: 0px 0px 10px 0px rgba(0, 0, 0, 0.1);
+    max-width: 400px;
+    width: 100%;
+    padding: 20px;
+    text-align: center;
+}
+.register-input {
+    border-radius: 5px;
+    border: 1px solid #ccc;
+    font-size: 16px;
+    margin-bottom: 10px;
+    padding: 10px;
+    width: calc(100% - 20px);
+}
+.register-button {
+    background-color: #4caf50;
+    border: none;
+    border-radius: 5px;
+    color: white;
+    cursor: pointer;
+    font-size: 16px;
+    padding: 10px 20px;
+    width: 100%;
+}
+.register-button:hover {
+    background-color: #45a049;
+}
+.login-link {
+    color: #61dafb;
+    display: block;
+    margin-top: 20px;
+    text-decoration: none;
+}
+.login-link:hover {
+    text-decoration: underline;
+}
+.search-container {
+    background-color: #3c4048;
+    border-radius: 10px;
+    box-shadow: 0px 0px 10px 0px rgba(0, 0, 0, 0.1);
+    max-width: 400px;
+    width: 100%;
+    padding: 20px;
+    text-align: center;
+}
+.search-input {
+    border-radius: 5px;
+    border: 1px solid #ccc;
+    font-size: 16px;
+    margin-bottom: 10px;
+    padding: 10px;
+    width: calc(100% - 20px);
+}
+.search-button {
+    background-color: #4caf50;
+    border: none;
+    border-radius: 5px;
+    color: white;
+    cursor: pointer;
+    font-size: 16px;
+    padding: 10px 20px;
+    width: 100%;
+}
+.search-button:hover {
+    background-color: #45a049;
+}
+.user-list {
+    list-style: none;
+    padding: 0;
+    margin: 0;
+}
+.user-item {
+    background-color: #525760;
+    border-radius: 5px;
+    margin-bottom: 10px;
+    padding: 10px;
+}
+.user-link {
+    color: white;
+    text-decoration: none;
+}
+.user-link:hover {
+    text-decoration: underline;
+}
+.online-dot {
+    background-color: #4caf50;
+    border-radius: 50%;
+    display: inline-block;
+    height: 8px;
+    margin-left: 5px;
+    width: 8px;
+}
+.online, .unread {
+    margin-top: 20px;
+}
+"""
+
+CHAT_JS = """
+// Shared by the global chat and the private conversation pages. The page
+// passes its values as data attributes on <body>: data-username,
+// data-heartbeat, data-unread on the global chat and data-partner on a
+// conversation.
+var chatPage = document.body.dataset;
+var socket = io.connect();
+var lastId = 0;
+document.querySelectorAll('#chat-messages .message[data-id]').forEach(function(element) {
+    lastId = Math.max(lastId, Number(element.dataset.id));
+});
+
+function createMessageElement(item) {
+    var messageElement = document.createElement('div');
+    messageElement.classList.add('message');
+    if (item.id) {
+        messageElement.dataset.id = item.id;
+    }
+    var usernameSpan = document.createElement('span');
+    usernameSpan.classList.add('username');
+    usernameSpan.textContent = item.username + ': ';
+    messageElement.appendChild(usernameSpan);
+    var contentSpan = document.createElement('span');
+    contentSpan.classList.add('content');
+    contentSpan.textContent = item.message;
+    messageElement.appendChild(contentSpan);
+    return messageElement;
+}
+
+// Batched 'messages' events carry [id, username, message, receiver, admin]
+// arrays; see MESSAGE_FIELDS.
+function expandMessage(record) {
+    return {'id': record[0], 'username': record[1], 'message': record[2],
+            'receiver': record[3], 'admin': record[4] === 1};
+}
+
+function appendMessage(item) {
+    if (item.id) {
+        if (document.querySelector('#chat-messages .message[data-id="' + item.id + '"]')) {
+            return;
+        }
+        lastId = Math.max(lastId, item.id);
+    }
+    document.getElementById('chat-messages').appendChild(createMessageElement(item));
+}
+
+// On connect and on every reconnect, fetch only the messages newer
+// than the last one shown instead of reloading the page.
+function syncMessages() {
+    var request = {'after': lastId};
+    if (chatPage.partner) {
+        request['with'] = chatPage.partner;
+    }
+    socket.emit('sync', request, function(data) {
+        if (data && data.retry_after) {
+            setTimeout(syncMessages, data.retry_after * 1000);
+            return;
+        }
+        if (!data || !data.messages) {
+            return;
+        }
+        data.messages.forEach(appendMessage);
+        if (data.more) {
+            syncMessages();
+        } else if (chatPage.partner && data.messages.length) {
+            markRead();
+        }
+    });
+}
+
+function markRead() {
+    socket.emit('read', {'with': chatPage.partner, 'id': lastId});
+}
+
+socket.on('connect', syncMessages);
+setInterval(function() {
+    socket.emit('heartbeat');
+}, Number(chatPage.heartbeat));
+
+function loadOlder() {
+    var button = document.getElementById('load-older');
+    var oldest = document.querySelector('#chat-messages .message[data-id]');
+    fetch(button.dataset.url + '?before=' + oldest.dataset.id)
+        .then(function(response) { return response.json(); })
+        .then(function(data) {
+            var chatMessages = document.getElementById('chat-messages');
+            data.messages.slice().reverse().forEach(function(item) {
+                chatMessages.insertBefore(createMessageElement(item), chatMessages.firstChild);
+            });
+            if (data.messages.length === 0) {
+                button.remove();
+            }
+        });
+}
+
+if (document.getElementById('load-older')) {
+    document.getElementById('load-older').addEventListener('click', loadOlder);
+}
+
+document.getElementById('message-form').addEventListener('submit', function(event) {
+    event.preventDefault();
+    var messageInput = document.getElementById('message-input');
+    var message = messageInput.value;
+    var receiver = document.getElementById('receiver').value;
+    messageInput.value = '';
+    sendMessage(message, receiver);
+});
+
+function sendMessage(message, receiver) {
+    if (message.trim() === '') {
+        return;
+    }
+
+    var messageElement = createMessageElement({'username': chatPage.username, 'message': message});
+    document.getElementById('chat-messages').appendChild(messageElement);
+
+    socket.emit('message', {'message': message, 'receiver': receiver}, function(ack) {
+        if (ack && ack.id) {
+            messageElement.dataset.id = ack.id;
+            lastId = Math.max(lastId, ack.id);
+        } else {
+            messageElement.classList.add('message-error');
+        }
+    });
+}
+
+var unreadTotal = Number(chatPage.unread || 0);
+
+function receiveMessage(data) {
+    if (chatPage.partner) {
+        if (data.receiver === chatPage.partner || (data.username === chatPage.partner && data.receiver !== 'all')) {
+            appendMessage(data);
+            if (data.username === chatPage.partner && data.id) {
+                markRead();
+            }
+        }
+        return;
+    }
+    if (data.receiver === chatPage.username && data.username !== chatPage.username) {
+        unreadTotal += 1;
+        document.getElementById('unread-total').textContent = ' (' + unreadTotal + ')';
+    }
+    appendMessage(data);
+}
+
+socket.on('message', receiveMessage);
+socket.on('messages', function(batch) {
+    batch.forEach(function(record) {
+        receiveMessage(expandMessage(record));
+    });
+});
+
+function sendAdminCommand() {
+    var commandInput = document.getElementById('admin-command-input');
+    var command = commandInput.value;
+    commandInput.value = '';
+    socket.emit('admin_command', {'command': command}, function(ack) {
+        if (ack && ack.error) {
+            document.getElementById('admin-output').textContent = ack.error;
+        }
+    });
+}
+
+var searchTimer = null;
+var searchSeq = 0;
+
+function searchMessages(page) {
+    var query = document.getElementById('search-input').value;
+    var results = document.getElementById('search-results');
+    var seq = page === 0 ? ++searchSeq : searchSeq;
+    if (page === 0) {
+        results.textContent = '';
+    }
+    if (query.trim() === '') {
+        return;
+    }
+    fetch('/search?q=' + encodeURIComponent(query) + '&page=' + page)
+        .then(function(response) { return response.json(); })
+        .then(function(data) {
+            // A newer query has replaced these results.
+            if (seq !== searchSeq) {
+                return;
+            }
+            var more = results.querySelector('.load-older');
+            if (more) {
+                more.remove();
+            }
+            (data.results || []).forEach(function(item) {
+                var label = item.receiver === 'all' ? item.username : item.username + ' → ' + item.receiver;
+                results.appendChild(createMessageElement({'username': label, 'message': item.message}));
+            });
+            if (data.more) {
+                var button = document.createElement('button');
+                button.classList.add('load-older');
+                button.textContent = 'More results';
+                button.addEventListener('click', function() { searchMessages(page + 1); });
+                results.appendChild(button);
+            }
+        });
+}
+
+if (document.getElementById('search-input')) {
+    document.getElementById('search-input').addEventListener('input', function() {
+        clearTimeout(searchTimer);
+        searchTimer = setTimeout(function() { searchMessages(0); }, 250);
+    });
+}
+
+socket.on('admin_progress', function(data) {
+    var output = document.getElementById('admin-output');
+    if (output) {
+        output.textContent = JSON.stringify(data, null, 2);
+    }
+});
+"""
+
+USERS_JS = """
+// Fills the online list on the user search pages, and the unread list on
+// the pages that have one.
+function userItem(username, text) {
+    var item = document.createElement('li');
+    item.classList.add('user-item');
+    var link = document.createElement('a');
+    link.classList.add('user-link');
+    link.href = '/mp/' + encodeURIComponent(username);
+    link.textContent = text;
+    item.appendChild(link);
+    return item;
+}
+
+if (document.getElementById('unread')) {
+    fetch('/unread')
+        .then(function(response) { return response.json(); })
+        .then(function(data) {
+            var list = document.getElementById('unread-conversations');
+            data.conversations.forEach(function(conversation) {
+                list.appendChild(userItem(conversation.username, conversation.username + ' (' + conversation.count + ')'));
+            });
+            document.getElementById('unread').hidden = data.conversations.length === 0;
+        });
+}
+
+fetch('/online')
+    .then(function(response) { return response.json(); })
+    .then(function(data) {
+        document.getElementById('online-count').textContent = data.count + ' online';
+        var list = document.getElementById('online-users');
+        data.users.forEach(function(user) {
+            list.appendChild(userItem(user, user));
+        });
+    });
+"""
+
+TEMPLATES = {
+    'index': INDEX_TEMPLATE,
+    'login': LOGIN_TEMPLATE,
+    'register': REGISTER_TEMPLATE,
+    'mp_search': MP_SEARCH_TEMPLATE,
+    'mp': MP_TEMPLATE,
+    'mp_chat': MP_CHAT_TEMPLATE,
+}
+
+# Pages whose output does not depend on the request; rendered once to bytes.
+STATIC_PAGES = ('login', 'register', 'mp')
+
+# Stylesheet and scripts shared by the pages. Each is served under a name
+# carrying a hash of its content, so browsers may keep it for good and a
+# changed file simply gets a new URL. Compressed variants are made once here.
+STATIC_ASSETS = {
+    'chat.css': CHAT_CSS,
+    'chat.js': CHAT_JS,
+    'users.js': USERS_JS,
+}
+
+# Fingerprinted file name -> (content type, digest, {encoding: body}).
+static_assets = {}
+asset_urls = {}
+
+def add_asset(name, body):
+    digest = hashlib.sha256(body).hexdigest()[:16]
+    stem, extension = os.path.splitext(name)
+    filename = '%s.%s%s' % (stem, digest, extension)
+    compressed = {'gzip': gzip.compress(body, 9, mtime=0)}
+    if brotli is not None:
+        compressed['br'] = brotli.compress(body)
+    variants = {encoding: data for encoding, data in compressed.items() if len(data) < len(body)}
+    variants['identity'] = body
+    static_assets[filename] = (mimetypes.guess_type(name)[0] + '; charset=utf-8', digest, variants)
+    asset_urls[name] = '/assets/' + filename
+
+def load_assets():
+    for name, source in STATIC_ASSETS.items():
+        add_asset(name, source.encode())
+    path = os.path.join(app.static_folder, app.config['SOCKETIO_CLIENT'])
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            add_asset('socket.io.js', f.read())
+    else:
+        asset_urls['socket.io.js'] = app.config['SOCKETIO_CLIENT_CDN']
+
+def asset_url(name):
+    return asset_urls[name]
+
+app.jinja_env.globals['asset_url'] = asset_url
+load_assets()
+
+compiled_templates = {}
+prerendered_pages = {}
+
+def get_template(name):
+    template = compiled_templates.get(name)
+    if template is None:
+        template = compiled_templates[name] = app.jinja_env.from_string(TEMPLATES[name])
+    return template
+
+def compile_templates():
+    for name in TEMPLATES:
+        get_template(name)
+
+def timed_render(name, context):
+    start = time.perf_counter()
+    page = render_template(get_template(name), **context)
+    if app.config['METRICS']:
+        metrics.observe('chat_template_render_seconds', (('template', name),), time.perf_counter() - start)
+    return page
+
+def render_page(name, **context):
+    if name in STATIC_PAGES and app.config['PRERENDER_STATIC_PAGES']:
+        page = prerendered_pages.get(name)
+        if page is None:
+            page = prerendered_pages[name] = timed_render(name, context).encode()
+        return page
+    return timed_render(name, context)
+
+# Request latency for a streamed page covers the time to its first byte;
+# the render histogram gets the whole render once the stream is done.
+def stream_page(name, **context):
+    app.update_template_context(context)
+    template = get_template(name)
+    chunk_size = app.config['STREAM_CHUNK_SIZE']
+
+    def generate():
+        start = time.perf_counter()
+        chunk = []
+        size = 0
+        for fragment in template.generate(context):
+            chunk.append(fragment)
+            size += len(fragment)
+            if size >= chunk_size:
+                yield ''.join(chunk)
+                chunk = []
+                size = 0
+        yield ''.join(chunk)
+        if app.config['METRICS']:
+            metrics.observe('chat_template_render_seconds', (('template', name),), time.perf_counter() - start)
+
+    return Response(stream_with_context(generate()), mimetype='text/html')
+
+compile_templates()
+
+GLOBAL_ROOM = 'all'
+
+def user_room(username):
+    return 'user:' + username
+
+def message_rooms(sender, receiver):
+    if receiver == 'all':
+        return GLOBAL_ROOM
+    return [user_room(receiver), user_room(sender)]
+
+def emit_message(payload, **kwargs):
+    rooms = message_rooms(payload['username'], payload['receiver'])
+    if app.config['PRESENCE_SKIP_OFFLINE']:
+        rooms = presence.live_rooms(payload['username'], payload['receiver'])
+        if not rooms:
+            presence.skipped_emits += 1
+            return
+    if app.config['EMIT_COALESCE_INTERVAL']:
+        coalesce_message(payload, rooms)
+        return
+    emit_stats['messages'] += 1
+    emit_stats['emits'] += 1
+    start = time.perf_counter()
+    socketio.emit('message', payload, to=rooms, **kwargs)
+    if app.config['METRICS']:
+        metrics.observe('chat_emit_duration_seconds', (), time.perf_counter() - start)
+
+# Order of the fields in a compact record of a 'messages' batch.
+MESSAGE_FIELDS = ('id', 'username', 'message', 'receiver', 'admin')
+
+def compact_message(payload):
+    return [payload.get('id'), payload['username'], payload['message'], payload['receiver'],
+            1 if payload.get('admin') else 0]
+
+# Messages waiting for the next flush, per room. A batch cannot skip the
+# sending socket the way a single emit does; that tab already holds the id from
+# its ack, which always reaches it before the batch, and drops the duplicate.
+outbound = {}
+outbound_lock = threading.Lock()
+emit_flusher = None
+emit_flusher_lock = threading.Lock()
+emit_stats = {'messages': 0, 'emits': 0}
+
+def start_emit_flusher():
+    global emit_flusher
+    with emit_flusher_lock:
+        if emit_flusher is None:
+            emit_flusher = socketio.start_background_task(run_emit_flusher)
+
+def coalesce_message(payload, rooms):
+    start_emit_flusher()
+    emit_stats['messages'] += 1
+    record = compact_message(payload)
+    with outbound_lock:
+        for room in [rooms] if isinstance(rooms, str) else rooms:
+            outbound.setdefault(room, []).append(record)
+
+def flush_outbound():
+    global outbound
+    with outbound_lock:
+        pending, outbound = outbound, {}
+    batch_max = app.config['EMIT_BATCH_MAX']
+    for room, records in pending.items():
+        for start in range(0, len(records), batch_max):
+            emit_start = time.perf_counter()
+            socketio.emit('messages', records[start:start + batch_max], to=room)
+            emit_stats['emits'] += 1
+            if app.config['METRICS']:
+                metrics.observe('chat_emit_duration_seconds', (), time.perf_counter() - emit_start)
+
+def run_emit_flusher():
+    while True:
+        socketio.sleep(app.config['EMIT_COALESCE_INTERVAL'])
+        flush_outbound()
+
+# Live sockets per user. Sockets are kept least recently seen first, so a
+# heartbeat is an O(1) move to the end and the sweeper only walks the entries
+# that actually expired.
+class Presence:
+    def __init__(self):
+        self.sockets = OrderedDict()
+        self.users = {}
+        self.skipped_emits = 0
+        self.lock = threading.Lock()
+
+    def add(self, username, sid):
+        with self.lock:
+            self.sockets[sid] = [username, time.monotonic()]
+            self.users.setdefault(username, set()).add(sid)
+
+    def touch(self, sid):
+        with self.lock:
+            entry = self.sockets.get(sid)
+            if entry is not None:
+                entry[1] = time.monotonic()
+                self.sockets.move_to_end(sid)
+
+    def remove(self, sid):
+        with self.lock:
+            entry = self.sockets.pop(sid, None)
+            if entry is None:
+                return
+            sids = self.users[entry[0]]
+            sids.discard(sid)
+            if not sids:
+                del self.users[entry[0]]
+
+    def expired(self, timeout):
+        deadline = time.monotonic() - timeout
+        stale = []
+        with self.lock:
+            for sid, (username, last_seen) in self.sockets.items():
+                if last_seen >= deadline:
+                    break
+                stale.append(sid)
+        return stale
+
+    def is_online(self, username):
+        return username in self.users
+
+    def count(self):
+        return len(self.users)
+
+    def online(self, limit):
+        return heapq.nsmallest(limit, list(self.users))
+
+    def live_rooms(self, sender, receiver):
+        if receiver == 'all':
+            return GLOBAL_ROOM if self.users else []
+        return [user_room(username) for username in (receiver, sender) if username in self.users]
+
+presence = Presence()
+presence_sweeper = None
+presence_sweeper_lock = threading.Lock()
+
+def start_presence_sweeper():
+    global presence_sweeper
+    with presence_sweeper_lock:
+        if presence_sweeper is None:
+            presence_sweeper = socketio.start_background_task(run_presence_sweeper)
+
+# Drops sockets that stopped sending heartbeats without a disconnect, such as
+# a laptop that went to sleep.
+def run_presence_sweeper():
+    while True:
+        socketio.sleep(app.config['PRESENCE_SWEEP_INTERVAL'])
+        for sid in presence.expired(app.config['PRESENCE_TIMEOUT']):
+            presence.remove(sid)
+            socketio.server.disconnect(sid)
+
+# Separator between the two usernames of a DM conversation key (ASCII unit
+# separator, matching char(31) in upgrade_messages_table).
+CONVERSATION_SEPARATOR = '\x1f'
+HISTORY_END = 2 ** 63 - 1
+
+# Buckets are kept least recently used first. One left alone long enough to
+# refill is the same as no bucket, so every check drops those from the front
+# and memory stays proportional to the clients that are actually busy.
+class RateLimiter:
+    def __init__(self, name):
+        self.name = name
+        self.buckets = OrderedDict()
+        self.allowed = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    # Takes a token for key; returns 0 on success, otherwise the seconds until
+    # the next token.
+    def take(self, key):
+        rate, burst = app.config[self.name]
+        now = time.monotonic()
+        with self.lock:
+            while self.buckets:
+                oldest = next(iter(self.buckets.values()))
+                if now - oldest[1] < (burst - oldest[0]) / rate:
+                    break
+                self.buckets.popitem(last=False)
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [burst, now]
+            else:
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+                self.buckets.move_to_end(key)
+            if bucket[0] < 1:
+                self.rejected += 1
+                return (1 - bucket[0]) / rate
+            bucket[0] -= 1
+            self.allowed += 1
+            return 0
+
+    def metrics(self):
+        return {'allowed': self.allowed, 'rejected': self.rejected, 'buckets': len(self.buckets)}
+
+rate_limiters = {name: RateLimiter(name) for name in ('MESSAGE_RATE_LIMIT', 'MESSAGE_IP_RATE_LIMIT',
+                                                      'SEARCH_RATE_LIMIT', 'SEARCH_IP_RATE_LIMIT',
+                                                      'SYNC_RATE_LIMIT', 'SYNC_IP_RATE_LIMIT')}
+
+# kind is 'MESSAGE', 'SEARCH' or 'SYNC'. The address bucket is only charged once the
+# user's own bucket has let the request through.
+def rate_limit_wait(kind, username):
+    if not app.config['RATE_LIMITS']:
+        return 0
+    return (rate_limiters[kind + '_RATE_LIMIT'].take(username)
+            or rate_limiters[kind + '_IP_RATE_LIMIT'].take(request.remote_addr))
+
+def too_many_requests(wait):
+    return 'Too many requests', 429, {'Retry-After': str(math.ceil(wait))}
+
+def conversation_key(sender, receiver):
+    if receiver == 'all':
+        return 'all'
+    return CONVERSATION_SEPARATOR.join(sorted((sender, receiver)))
+
+# The statement that stores a message row, taking the usernames and the
+# conversation key from message_params.
+INSERT_MESSAGE = '''INSERT INTO messages (sender_id, receiver_id, conversation_id, created, message)
+                    VALUES ((SELECT id FROM users WHERE username=?), (SELECT id FROM users WHERE username=?),
+                            (SELECT id FROM conversations WHERE key=?), ?, ?)'''
+
+def message_params(sender, receiver, message, created):
+    return (sender, None if receiver == 'all' else receiver, conversation_key(sender, receiver), created, message)
+
+# rows are (sender, receiver, message, created) tuples.
+def insert_messages(c, rows):
+    params = [message_params(*row) for row in rows]
+    c.executemany("INSERT OR IGNORE INTO conversations (key) VALUES (?)", {(row[2],) for row in params})
+    c.executemany(INSERT_MESSAGE, params)
+
+def insert_message(c, sender, receiver, message):
+    params = message_params(sender, receiver, message, int(time.time()))
+    c.execute("INSERT OR IGNORE INTO conversations (key) VALUES (?)", (params[2],))
+    c.execute(INSERT_MESSAGE, params)
+    return c.lastrowid
+
+def fetch_conversation_page(c, conversation, before=None, limit=None):
+    limit = limit or app.config['HISTORY_PAGE_SIZE']
+    c.execute('''SELECT m.id, u.username, m.message FROM messages m CROSS JOIN users u ON u.id=m.sender_id
+                 WHERE m.conversation_id=(SELECT id FROM conversations WHERE key=?) AND m.id<?
+                 ORDER BY m.id DESC LIMIT ?''', (conversation, before or HISTORY_END, limit))
+    rows = c.fetchall()[::-1]
+    return archived_page(c, [conversation], rows, before, limit) + rows
+
+def fetch_inbox_page(c, username, before=None, limit=None):
+    limit = limit or app.config['HISTORY_PAGE_SIZE']
+    before = before or HISTORY_END
+    c.execute('''SELECT m.id, u.username, m.message FROM (
+                     SELECT id, sender_id, message FROM (
+                         SELECT id, sender_id, message FROM messages
+                         WHERE conversation_id=(SELECT id FROM conversations WHERE key='all') AND id<?
+                         ORDER BY id DESC LIMIT ?)
+                     UNION ALL
+                     SELECT id, sender_id, message FROM (
+                         SELECT id, sender_id, message FROM messages
+                         WHERE receiver_id=(SELECT id FROM users WHERE username=?) AND id<?
+                         ORDER BY id DESC LIMIT ?)
+                     ORDER BY id DESC LIMIT ?) m
+                 CROSS JOIN users u ON u.id=m.sender_id
+                 ORDER BY m.id DESC''', (before, limit, username, before, limit, limit))
+    rows = c.fetchall()[::-1]
+    return archived_page(c, ['all', 'inbox:' + username], rows, before, limit) + rows
+
+def fetch_received_page(c, username, before=None, limit=None):
+    limit = limit or app.config['HISTORY_PAGE_SIZE']
+    c.execute('''SELECT m.id, u.username, m.message FROM messages m CROSS JOIN users u ON u.id=m.sender_id
+                 WHERE m.receiver_id=(SELECT id FROM users WHERE username=?) AND m.id<?
+                 ORDER BY m.id DESC LIMIT ?''', (username, before or HISTORY_END, limit))
+    rows = c.fetchall()[::-1]
+    return archived_page(c, ['inbox:' + username], rows, before, limit) + rows
+
+def archive_keys(sender, receiver):
+    keys = [conversation_key(sender, receiver)]
+    if receiver != 'all':
+        keys.append('inbox:' + receiver)
+    return keys
+
+# Segments never change once written, so recently read ones are kept decoded.
+decoded_segments = OrderedDict()
+decoded_segments_lock = threading.Lock()
+
+def decode_segment(segment_id, payload):
+    with decoded_segments_lock:
+        rows = decoded_segments.get(segment_id)
+        if rows is not None:
+            decoded_segments.move_to_end(segment_id)
+            return rows
+    rows = json.loads(zlib.decompress(payload))
+    with decoded_segments_lock:
+        decoded_segments[segment_id] = rows
+        while len(decoded_segments) > app.config['ARCHIVE_SEGMENT_CACHE']:
+            decoded_segments.popitem(last=False)
+    return rows
+
+# Tops a short page from the messages table up with older rows from the
+# archive. Everything archived is older than everything left in messages, so
+# the archive is only consulted once the hot table runs out.
+def archived_page(c, keys, rows, before, limit):
+    if len(rows) >= limit:
+        return []
+    return archived_rows(c, keys, rows[0][0] if rows else before or HISTORY_END, limit - len(rows))
+
+# The newest wanted archived rows for keys with ids below before, oldest first.
+def archived_rows(c, keys, before, wanted):
+    placeholders = ', '.join('?' * len(keys))
+    c.execute('''SELECT DISTINCT s.id, k.last_id, s.payload FROM archive.segment_keys k
+                 JOIN archive.segments s ON s.id=k.segment_id
+                 WHERE k.key IN (%s) AND k.first_id<?
+                 ORDER BY k.last_id DESC''' % placeholders, keys + [before])
+    found = []
+    seen = set()
+    for segment_id, last_id, payload in c.fetchall():
+        if len(found) >= wanted and last_id < found[wanted - 1][0]:
+            break
+        if segment_id in seen:
+            continue
+        seen.add(segment_id)
+        for id, sender, receiver, message, created in decode_segment(segment_id, payload):
+            if id < before and set(archive_keys(sender, receiver)) & set(keys):
+                found.append((id, sender, message))
+        found.sort(reverse=True)
+        del found[wanted:]
+    return found[::-1]
+
+# A conversation page as a lazy row iterator, oldest first, for pages too
+# long to hold as a list. Only the id bounding the page is looked up front;
+# the rows come off the cursor as the template consumes them.
+def iter_conversation_page(c, conversation, limit=None):
+    limit = limit or app.config['HISTORY_PAGE_SIZE']
+    c.execute("SELECT id FROM conversations WHERE key=?", (conversation,))
+    row = c.fetchone()
+    conversation_id = row[0] if row else None
+    c.execute('''SELECT id FROM messages WHERE conversation_id=?
+                 ORDER BY id DESC LIMIT 1 OFFSET ?''', (conversation_id, limit - 1))
+    row = c.fetchone()
+    if row:
+        first = row[0]
+    else:
+        c.execute("SELECT count(*), min(id) FROM messages WHERE conversation_id=?", (conversation_id,))
+        count, first = c.fetchone()
+        first = first or HISTORY_END
+        yield from archived_rows(c, [conversation], first, limit - count)
+    yield from c.execute('''SELECT m.id, u.username, m.message FROM messages m CROSS JOIN users u ON u.id=m.sender_id
+                            WHERE m.conversation_id=? AND m.id>=? ORDER BY m.id''', (conversation_id, first))
+
+def fetch_conversation_since(c, conversation, after, limit):
+    c.execute('''SELECT m.id, u.username, m.message FROM messages m CROSS JOIN users u ON u.id=m.sender_id
+                 WHERE m.conversation_id=(SELECT id FROM conversations WHERE key=?) AND m.id>?
+                 ORDER BY m.id LIMIT ?''', (conversation, after, limit))
+    return c.fetchall()
+
+def fetch_inbox_since(c, username, after, limit):
+    c.execute('''SELECT m.id, u.username, m.message FROM (
+                     SELECT id, sender_id, message FROM (
+                         SELECT id, sender_id, message FROM messages
+                         WHERE conversation_id=(SELECT id FROM conversations WHERE key='all') AND id>?
+                         ORDER BY id LIMIT ?)
+                     UNION ALL
+                     SELECT id, sender_id, message FROM (
+                         SELECT id, sender_id, message FROM messages
+                         WHERE receiver_id=(SELECT id FROM users WHERE username=?) AND id>?
+                         ORDER BY id LIMIT ?)
+                     ORDER BY id LIMIT ?) m
+                 CROSS JOIN users u ON u.id=m.sender_id
+                 ORDER BY m.id''', (after, limit, username, after, limit, limit))
+    return c.fetchall()
+
+# Every word is quoted so user input never reaches the FTS5 query syntax.
+# Words match whole; there is no prefix index, and a prefix query on a short
+# stem has to merge the postings of every word it starts.
+def search_query(text):
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    return ' '.join('"%s"' % word for word in words)
+
+def search_messages(c, username, text, offset=0, limit=None):
+    limit = limit or app.config['SEARCH_PAGE_SIZE']
+    query = search_query(text)
+    if query is None:
+        return []
+    # The inner query walks matches newest first and stops after
+    # SEARCH_CANDIDATES visible ones; only those are ranked with bm25.
+    c.execute("SELECT id FROM users WHERE username=?", (username,))
+    row = c.fetchone()
+    if row is None:
+        return []
+    c.execute('''SELECT m.id, s.username, coalesce(r.username, 'all'), m.message FROM (
+                     SELECT m.id, m.sender_id, m.receiver_id, m.message, messages_fts.rank AS rank
+                     FROM messages_fts JOIN messages m ON m.id=messages_fts.rowid
+                     WHERE messages_fts MATCH ?
+                     AND (m.receiver_id IS NULL OR m.sender_id=? OR m.receiver_id=?)
+                     ORDER BY messages_fts.rowid DESC LIMIT ?) m
+                 JOIN users s ON s.id=m.sender_id
+                 LEFT JOIN users r ON r.id=m.receiver_id
+                 ORDER BY m.rank, m.id DESC LIMIT ? OFFSET ?''',
+              (query, row[0], row[0], app.config['SEARCH_CANDIDATES'], limit, offset))
+    return c.fetchall()
+
+def messages_json(messages):
+    return [{'id': id, 'username': sender, 'message': message} for id, sender, message in messages]
+
+def history_json(messages):
+    return jsonify(messages=messages_json(messages))
+
+# Bounded buffers of the newest messages, keyed by conversation key or by
+# ('inbox', username) for the DMs a user received. Buffers are filled from the
+# database on first use and kept current by the message writer; the least
+# recently read ones are dropped once HISTORY_CACHE_MAX_MESSAGES rows or
+# HISTORY_CACHE_MAX_BUFFERS buffers are held. Empty loads are not kept, since
+# any key can be asked for; the first message to a conversation then simply
+# finds no buffer to append to. The global channel is never evicted.
+class RecentHistory:
+    def __init__(self):
+        self.buffers = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, load):
+        with self.lock:
+            buffer = self.buffers.get(key)
+            if buffer is None:
+                self.misses += 1
+                # Loading under the lock keeps a concurrent append from being
+                # lost between the database read and the buffer insert.
+                buffer = deque(load(), maxlen=app.config['HISTORY_CACHE_DEPTH'])
+                if not buffer:
+                    return []
+                self.buffers[key] = buffer
+                self.size += len(buffer)
+                self.evict()
+            else:
+                self.hits += 1
+                self.buffers.move_to_end(key)
+            return list(buffer)
+
+    def append(self, key, row):
+        with self.lock:
+            buffer = self.buffers.get(key)
+            if buffer is None or (buffer and buffer[-1][0] >= row[0]):
+                return
+            if len(buffer) < buffer.maxlen:
+                self.size += 1
+            buffer.append(row)
+            self.evict()
+
+    def evict(self):
+        while (self.size > app.config['HISTORY_CACHE_MAX_MESSAGES']
+               or len(self.buffers) > app.config['HISTORY_CACHE_MAX_BUFFERS']):
+            key = next((key for key in self.buffers if key != 'all'), None)
+            if key is None:
+                return
+            self.size -= len(self.buffers.pop(key))
+
+    def clear(self):
+        with self.lock:
+            self.buffers.clear()
+            self.size = 0
+
+recent_history = RecentHistory()
+
+def use_recent_history(limit):
+    return app.config['HISTORY_CACHE'] and limit <= app.config['HISTORY_CACHE_DEPTH']
+
+def recent_conversation_page(c, conversation, limit=None):
+    limit = limit or app.config['HISTORY_PAGE_SIZE']
+    if not use_recent_history(limit):
+        return fetch_conversation_page(c, conversation, limit=limit)
+    depth = app.config['HISTORY_CACHE_DEPTH']
+    rows = recent_history.get(conversation, lambda: fetch_conversation_page(c, conversation, limit=depth))
+    return rows[-limit:]
+
+def recent_inbox_page(c, username, limit=None):
+    limit = limit or app.config['HISTORY_PAGE_SIZE']
+    if not use_recent_history(limit):
+        return fetch_inbox_page(c, username, limit=limit)
+    depth = app.config['HISTORY_CACHE_DEPTH']
+    rows = recent_history.get('all', lambda: fetch_conversation_page(c, 'all', limit=depth))
+    rows += recent_history.get(('inbox', username), lambda: fetch_received_page(c, username, limit=depth))
+    return sorted(rows)[-limit:]
+
+# A buffer answers "everything after id N" when it still reaches back to N,
+# or when it has never filled up and so holds the whole conversation.
+def buffer_covers(rows, after):
+    return len(rows) < app.config['HISTORY_CACHE_DEPTH'] or rows[0][0] <= after
+
+def recent_conversation_since(c, conversation, after, limit):
+    if app.config['HISTORY_CACHE']:
+        depth = app.config['HISTORY_CACHE_DEPTH']
+        rows = recent_history.get(conversation, lambda: fetch_conversation_page(c, conversation, limit=depth))
+        if buffer_covers(rows, after):
+            return [row for row in rows if row[0] > after][:limit]
+    return fetch_conversation_since(c, conversation, after, limit)
+
+def recent_inbox_since(c, username, after, limit):
+    if app.config['HISTORY_CACHE']:
+        depth = app.config['HISTORY_CACHE_DEPTH']
+        shared = recent_history.get('all', lambda: fetch_conversation_page(c, 'all', limit=depth))
+        received = recent_history.get(('inbox', username), lambda: fetch_received_page(c, username, limit=depth))
+        if buffer_covers(shared, after) and buffer_covers(received, after):
+            return sorted(row for row in shared + received if row[0] > after)[:limit]
+    return fetch_inbox_since(c, username, after, limit)
+
+def cache_message(pending):
+    row = (pending.id, pending.sender, pending.message)
+    recent_history.append(conversation_key(pending.sender, pending.receiver), row)
+    if pending.receiver != 'all':
+        recent_history.append(('inbox', pending.receiver), row)
+
+def warm_recent_history():
+    if not app.config['HISTORY_CACHE']:
+        return
+    with app.app_context():
+        c = get_db().cursor()
+        depth = app.config['HISTORY_CACHE_DEPTH']
+        recent_conversation_page(c, 'all', depth)
+        c.execute('''SELECT k.key FROM messages m JOIN conversations k ON k.id=m.conversation_id
+                     WHERE m.receiver_id IS NOT NULL
+                     GROUP BY m.conversation_id ORDER BY max(m.id) DESC LIMIT ?''',
+                  (app.config['HISTORY_CACHE_WARM_CONVERSATIONS'],))
+        for (conversation,) in c.fetchall()[::-1]:
+            recent_conversation_page(c, conversation, depth)
+
+UNREAD_QUERY = '''SELECT ru.username AS receiver, su.username AS sender, m.id FROM messages m
+                  JOIN users ru ON ru.id=m.receiver_id
+                  JOIN users su ON su.id=m.sender_id
+                  JOIN conversations k ON k.id=m.conversation_id
+                  LEFT JOIN read_marks r ON r.username=ru.username AND r.conversation=k.key
+                  WHERE m.receiver_id!=m.sender_id AND m.id>coalesce(r.last_read_id, 0)'''
+
+# Ids of the unread DMs of each user, grouped by sender: {receiver: {sender:
+# deque of ids}}. Rebuilt from messages and read_marks at startup and kept
+# current by the message writer, so counts never touch SQLite.
+class UnreadCounters:
+    def __init__(self):
+        self.inboxes = {}
+        self.lock = threading.Lock()
+
+    def add(self, receiver, sender, message_id):
+        with self.lock:
+            self.inboxes.setdefault(receiver, {}).setdefault(sender, deque()).append(message_id)
+
+    def mark_read(self, username, sender, last_read_id):
+        with self.lock:
+            inbox = self.inboxes.get(username, {})
+            ids = inbox.get(sender)
+            cleared = 0
+            while ids and ids[0] <= last_read_id:
+                ids.popleft()
+                cleared += 1
+            if ids is not None and not ids:
+                del inbox[sender]
+                if not inbox:
+                    del self.inboxes[username]
+            return cleared
+
+    def conversations(self, username):
+        with self.lock:
+            return [(sender, len(ids), ids[-1]) for sender, ids in self.inboxes.get(username, {}).items()]
+
+    def load(self, rows):
+        inboxes = {}
+        for receiver, sender, message_id in rows:
+            inboxes.setdefault(receiver, {}).setdefault(sender, deque()).append(message_id)
+        with self.lock:
+            self.inboxes = inboxes
+
+unread = UnreadCounters()
+
+def load_unread():
+    if not app.config['UNREAD_CACHE']:
+        return
+    with app.app_context():
+        c = get_db().cursor()
+        c.execute(UNREAD_QUERY + " ORDER BY m.id")
+        unread.load(c)
+
+def track_unread(pending):
+    if app.config['UNREAD_CACHE'] and pending.receiver != 'all' and pending.receiver != pending.sender:
+        unread.add(pending.receiver, pending.sender, pending.id)
+
+# Returns (sender, unread count, newest unread id), newest first.
+def unread_conversations(c, username):
+    if app.config['UNREAD_CACHE']:
+        rows = unread.conversations(username)
+    else:
+        c.execute('''SELECT sender, count(*), max(id) FROM (''' + UNREAD_QUERY + '''
+                         AND m.receiver_id=(SELECT id FROM users WHERE username=?))
+                     GROUP BY sender''', (username,))
+        rows = c.fetchall()
+    return sorted(rows, key=lambda row: row[2], reverse=True)
+
+def mark_read(db, username, partner, last_read_id):
+    if unread.mark_read(username, partner, last_read_id) == 0 and app.config['UNREAD_CACHE']:
+        return
+    db.execute('''INSERT INTO read_marks (username, conversation, last_read_id) VALUES (?, ?, ?)
+                  ON CONFLICT (username, conversation)
+                  DO UPDATE SET last_read_id=max(last_read_id, excluded.last_read_id)''',
+               (username, conversation_key(username, partner), last_read_id))
+    db.commit()
+
+class PendingMessage:
+    def __init__(self, sender, receiver, message):
+        self.sender = sender
+        self.receiver = receiver
+        self.message = message
+        self.created = int(time.time())
+        self.id = None
+        self.error = None
+        self.committed = threading.Event()
+
+    def row(self):
+        return (self.sender, self.receiver, self.message, self.created)
+
+    def wait(self, timeout=None):
+        self.committed.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.id
+
+message_queue = queue.Queue()
+message_writer = None
+message_writer_lock = threading.Lock()
+write_stats = {'batches': 0, 'messages': 0, 'max_batch_size': 0,
+               'flush_seconds': 0.0, 'max_flush_seconds': 0.0}
+
+def start_message_writer():
+    global message_writer
+    with message_writer_lock:
+        if message_writer is None:
+            message_writer = socketio.start_background_task(run_message_writer)
+
+def queue_message(sender, receiver, message):
+    if message_writer is None:
+        start_message_writer()
+    pending = PendingMessage(sender, receiver, message)
+    message_queue.put(pending)
+    return pending
+
+def wait_for_write(pending):
+    if app.config['WRITE_DURABILITY'] == 'commit':
+        return pending.wait()
+
+def flush_messages():
+    message_queue.join()
+
+def next_batch():
+    batch = [message_queue.get()]
+    deadline = time.monotonic() + app.config['WRITE_BATCH_INTERVAL']
+    while len(batch) < app.config['WRITE_BATCH_SIZE']:
+        timeout = deadline - time.monotonic()
+        try:
+            if timeout > 0:
+                batch.append(message_queue.get(timeout=timeout))
+            else:
+                batch.append(message_queue.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+# The messages of batch whose sender and receiver still exist. The others,
+# from or to an account deleted since they were queued, fail on their own
+# instead of failing the batch or turning into global messages.
+def known_user_messages(c, batch):
+    names = list({name for pending in batch for name in (pending.sender, pending.receiver) if name != 'all'})
+    c.execute("SELECT username FROM users WHERE username IN (%s)" % ','.join('?' * len(names)), names)
+    missing = set(names) - {row[0] for row in c.fetchall()}
+    stored = []
+    for pending in batch:
+        if pending.sender in missing or pending.receiver in missing:
+            pending.error = sqlite3.IntegrityError('unknown user')
+        else:
+            stored.append(pending)
+    return stored
+
+def flush_batch(db, batch):
+    start = time.perf_counter()
+    c = db.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        stored = known_user_messages(c, batch)
+        insert_messages(c, [pending.row() for pending in stored])
+        c.execute("SELECT last_insert_rowid()")
+        last_id = c.fetchone()[0]
+        db.commit()
+    except sqlite3.Error as e:
+        db.rollback()
+        app.logger.exception('Failed to write a batch of %d messages', len(batch))
+        for pending in batch:
+            pending.error = e
+    else:
+        # The batch is the only writer inside its IMMEDIATE transaction, so
+        # AUTOINCREMENT handed out consecutive ids ending at last_id.
+        for offset, pending in enumerate(stored):
+            pending.id = last_id - len(stored) + 1 + offset
+            cache_message(pending)
+            track_unread(pending)
+    elapsed = time.perf_counter() - start
+
+    write_stats['batches'] += 1
+    write_stats['messages'] += len(batch)
+    write_stats['max_batch_size'] = max(write_stats['max_batch_size'], len(batch))
+    write_stats['flush_seconds'] += elapsed
+    write_stats['max_flush_seconds'] = max(write_stats['max_flush_seconds'], elapsed)
+    for pending in batch:
+        pending.committed.set()
+        message_queue.task_done()
+
+def run_message_writer():
+    db = connect_db()
+    while True:
+        flush_batch(db, next_batch())
+
+def write_metrics():
+    batches = write_stats['batches'] or 1
+    return dict(write_stats,
+                mean_batch_size=write_stats['messages'] / batches,
+                mean_flush_seconds=write_stats['flush_seconds'] / batches,
+                queued=message_queue.qsize())
+
+ARCHIVE_ROWS = '''SELECT m.id, s.username, coalesce(r.username, 'all'), m.message, m.created
+                  FROM messages m JOIN users s ON s.id=m.sender_id
+                  LEFT JOIN users r ON r.id=m.receiver_id'''
+
+# Moves the oldest messages to the archive, at most RETENTION_BATCH per tick.
+# The segment is written and committed first; then exactly the rows it holds
+# are deleted from messages. A tick that stopped in between leaves the newest
+# segment holding the oldest rows of messages, and the next tick only
+# finishes the delete. Nothing is deleted on the strength of an archive
+# alone, so an archive left over from another chat.db cannot take rows with
+# it. BEGIN IMMEDIATE keeps the archivers of several worker processes from
+# archiving the same rows twice.
+def archive_tick(db):
+    cutoff = int(time.time()) - app.config['RETENTION_AGE']
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        expired = unfinished_segment(db)
+        if expired is None:
+            rows = db.execute(ARCHIVE_ROWS + " ORDER BY m.id LIMIT ?", (app.config['RETENTION_BATCH'],)).fetchall()
+            expired = []
+            for row in rows:
+                if (row[4] or 0) >= cutoff:
+                    break
+                expired.append(row)
+            if expired:
+                store_segment(db, expired)
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    if expired:
+        db.execute("DELETE FROM messages WHERE id BETWEEN ? AND ?", (expired[0][0], expired[-1][0]))
+        db.commit()
+    # execute() would only step the pragma once, freeing a single page.
+    db.executescript("PRAGMA incremental_vacuum(%d)" % app.config['RETENTION_VACUUM_PAGES'])
+    return len(expired)
+
+# The rows of the newest segment if they are also still the oldest rows of
+# messages, as a tick that stopped before its delete leaves them.
+def unfinished_segment(db):
+    segment = db.execute("SELECT first_id, last_id, payload FROM archive.segments ORDER BY id DESC LIMIT 1").fetchone()
+    if segment is None:
+        return None
+    first_id, last_id, payload = segment
+    if db.execute("SELECT min(id) FROM messages").fetchone()[0] != first_id:
+        return None
+    rows = db.execute(ARCHIVE_ROWS + " WHERE m.id BETWEEN ? AND ? ORDER BY m.id", (first_id, last_id)).fetchall()
+    if [list(row) for row in rows] != json.loads(zlib.decompress(payload)):
+        return None
+    return rows
+
+def store_segment(db, rows, segment_id=None):
+    payload = zlib.compress(json.dumps(rows, separators=(',', ':')).encode())
+    segment_id = db.execute("INSERT INTO archive.segments (id, first_id, last_id, payload) VALUES (?, ?, ?, ?)",
+                            (segment_id, rows[0][0], rows[-1][0], payload)).lastrowid
+    ranges = {}
+    for id, sender, receiver, message, created in rows:
+        for key in archive_keys(sender, receiver):
+            ranges.setdefault(key, [id, id])[1] = id
+    db.executemany("INSERT INTO archive.segment_keys (key, first_id, last_id, segment_id) VALUES (?, ?, ?, ?)",
+                   [(key, first_id, last_id, segment_id) for key, (first_id, last_id) in ranges.items()])
+
+retention_worker = None
+retention_worker_lock = threading.Lock()
+
+def start_retention_worker():
+    global retention_worker
+    if app.config['RETENTION_AGE'] is None:
+        return
+    with retention_worker_lock:
+        if retention_worker is None:
+            retention_worker = socketio.start_background_task(run_retention_worker)
+
+def run_retention_worker():
+    db = connect_db()
+    while True:
+        try:
+            archived = archive_tick(db)
+        except sqlite3.Error:
+            app.logger.exception('Archiving messages failed')
+            archived = 0
+        # A full batch means more expired rows are waiting.
+        if archived == app.config['RETENTION_BATCH']:
+            socketio.sleep(app.config['RETENTION_PAUSE'])
+        else:
+            socketio.sleep(app.config['RETENTION_INTERVAL'])
+
+warm_recent_history()
+load_unread()
+
+def trigrams(text):
+    padded = '  ' + text + ' '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def min_shared_trigrams(query, length, cutoff):
+    # ratio() >= cutoff needs at least `matched` characters in common. Each
+    # unmatched query character can break at most three query trigrams and
+    # each unmatched name character at most two, so a name of this length
+    # sharing fewer trigrams cannot reach the cutoff.
+    matched = math.ceil(cutoff * (len(query) + length) / 2 - 1e-9)
+    if matched > min(len(query), length):
+        return None
+    return len(trigrams(query)) - 3 * (len(query) - matched) - 2 * (length - matched)
+
+# In-memory username index for the /mp search. Fuzzy candidates come from the
+# trigram postings, pruned with a bound that never drops a name able to reach
+# the cutoff, and are then scored with SequenceMatcher exactly like
+# difflib.get_close_matches, so results and ranking are unchanged. Prefix
+# matches from a sorted list fill any remaining slots.
+class UserSearchIndex:
+    def __init__(self):
+        self.names = []
+        self.sorted_names = []
+        self.postings = {}
+        self.lock = threading.Lock()
+
+    def index(self, username):
+        position = len(self.names)
+        self.names.append(username)
+        for gram in trigrams(username):
+            self.postings.setdefault(gram, []).append(position)
+
+    def add(self, username):
+        with self.lock:
+            self.index(username)
+            bisect.insort(self.sorted_names, username)
+
+    def extend(self, usernames):
+        with self.lock:
+            for username in usernames:
+                self.index(username)
+            self.sorted_names = sorted(self.names)
+
+    def update(self, usernames):
+        if len(usernames) > 1:
+            self.extend(usernames)
+        else:
+            self.add(usernames[0])
+
+    def clear(self):
+        with self.lock:
+            self.names = []
+            self.sorted_names = []
+            self.postings = {}
+
+    def prefix(self, query, n):
+        start = bisect.bisect_left(self.sorted_names, query)
+        return [name for name in self.sorted_names[start:start + n] if name.startswith(query)]
+
+    def fuzzy(self, query, n, cutoff):
+        longest = int(len(query) * (2 - cutoff) / cutoff) + 1
+        thresholds = {length: min_shared_trigrams(query, length, cutoff) for length in range(longest + 1)}
+        if any(threshold is not None and threshold <= 0 for threshold in thresholds.values()):
+            return get_close_matches(query, self.names, n, cutoff)
+
+        counts = Counter()
+        for gram in trigrams(query):
+            counts.update(self.postings.get(gram, ()))
+
+        matcher = SequenceMatcher()
+        matcher.set_seq2(query)
+        scored = []
+        for position, count in counts.items():
+            name = self.names[position]
+            threshold = thresholds.get(len(name))
+            if threshold is None or count < threshold:
+                continue
+            matcher.set_seq1(name)
+            if (matcher.real_quick_ratio() >= cutoff and matcher.quick_ratio() >= cutoff
+                    and matcher.ratio() >= cutoff):
+                scored.append((matcher.ratio(), name))
+        return [name for score, name in heapq.nlargest(n, scored)]
+
+    def search(self, query, n=5, cutoff=0.8):
+        matches = self.fuzzy(query, n, cutoff)
+        for name in self.prefix(query, n):
+            if len(matches) >= n:
+                break
+            if name not in matches:
+                matches.append(name)
+        return matches
+
+user_index = UserSearchIndex()
+
+# In-memory copy of the users table for existence checks, the user count and
+# alphabetical pages. New rows are pulled by id on register, on a lookup of an
+# unknown name and at least every USER_DIRECTORY_REFRESH seconds, which also
+# picks up users registered through other worker processes. Listeners (the
+# /mp search index) get every batch of new names and are cleared along with
+# the directory by invalidate().
+class UserDirectory:
+    def __init__(self):
+        self.ids = {}
+        self.sorted_names = []
+        self.last_id = 0
+        self.synced_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def sync(self, c):
+        with self.lock:
+            c.execute("SELECT id, username FROM users WHERE id>? ORDER BY id", (self.last_id,))
+            rows = c.fetchall()
+            self.synced_at = time.monotonic()
+            if not rows:
+                return
+            names = [username for id, username in rows]
+            self.ids.update((username, id) for id, username in rows)
+            if len(names) > 1:
+                self.sorted_names = sorted(self.ids)
+            else:
+                bisect.insort(self.sorted_names, names[0])
+            self.last_id = rows[-1][0]
+            for listener in self.listeners:
+                listener.update(names)
+
+    def refresh(self, c):
+        if time.monotonic() - self.synced_at < app.config['USER_DIRECTORY_REFRESH']:
+            self.hits += 1
+            return
+        self.misses += 1
+        self.sync(c)
+
+    def count(self, c):
+        self.refresh(c)
+        return len(self.ids)
+
+    def page(self, c, after='', limit=None):
+        self.refresh(c)
+        limit = limit or app.config['USER_PAGE_SIZE']
+        start = bisect.bisect_right(self.sorted_names, after)
+        return self.sorted_names[start:start + limit]
+
+    def exists(self, c, username):
+        if username in self.ids:
+            self.hits += 1
+            return True
+        self.misses += 1
+        self.sync(c)
+        return username in self.ids
+
+    def user_id(self, c, username):
+        user_id = self.ids.get(username)
+        if user_id is not None:
+            self.hits += 1
+            return user_id
+        self.misses += 1
+        self.sync(c)
+        return self.ids.get(username)
+
+    def invalidate(self):
+        with self.lock:
+            self.ids = {}
+            self.sorted_names = []
+            self.last_id = 0
+            self.synced_at = 0.0
+            for listener in self.listeners:
+                listener.clear()
+
+    def metrics(self):
+        lookups = self.hits + self.misses
+        return {'users': len(self.ids), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+user_directory = UserDirectory()
+user_directory.listeners.append(user_index)
+
+def load_user_directory():
+    with app.app_context():
+        user_directory.sync(get_db().cursor())
+
+load_user_directory()
+
+# Password hashes are stored as 'scrypt$n$r$p$salt$key' or
+# 'pbkdf2_sha256$iterations$salt$key' with hex salt and key. Older rows hold a
+# bare sha256 hex digest and are re-hashed on the next successful login.
+def derive_key(algorithm, params, password, salt):
+    if algorithm == 'scrypt':
+        n, r, p = params
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, dklen=32)
+    if algorithm == 'pbkdf2_sha256':
+        iterations, = params
+        return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+    raise ValueError('Unknown password hash algorithm %r' % algorithm)
+
+def kdf_params():
+    if app.config['PASSWORD_KDF'] == 'scrypt':
+        return 'scrypt', (app.config['SCRYPT_N'], app.config['SCRYPT_R'], app.config['SCRYPT_P'])
+    return 'pbkdf2_sha256', (app.config['PBKDF2_ITERATIONS'],)
+
+# At most PASSWORD_HASH_WORKERS derivations run at once, each through
+# run_blocking, so a burst of logins neither stalls the event loop nor takes
+# every core away from the chat itself.
+password_hash_slots = threading.BoundedSemaphore(app.config['PASSWORD_HASH_WORKERS'])
+
+def run_kdf(algorithm, params, password, salt):
+    with password_hash_slots:
+        return run_blocking(derive_key, algorithm, params, password, salt)
+
+def hash_password(password):
+    algorithm, params = kdf_params()
+    salt = os.urandom(16)
+    key = run_kdf(algorithm, params, password, salt)
+    return '$'.join([algorithm] + [str(value) for value in params] + [salt.hex(), key.hex()])
+
+# Returns (matches, needs_rehash).
+def verify_password(password, stored):
+    if '$' not in stored:
+        return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored), True
+    algorithm, *fields = stored.split('$')
+    params = tuple(int(value) for value in fields[:-2])
+    key = run_kdf(algorithm, params, password, bytes.fromhex(fields[-2]))
+    return hmac.compare_digest(key, bytes.fromhex(fields[-1])), (algorithm, params) != kdf_params()
+
+def check_credentials(db, username, password):
+    user = db.execute("SELECT id, password_hash, is_admin FROM users WHERE username=?", (username,)).fetchone()
+    if user is None:
+        # Costs as much as a real check, so timing does not reveal which
+        # usernames exist.
+        hash_password(password)
+        return None
+    matches, needs_rehash = verify_password(password, user[1])
+    if not matches:
+        return None
+    if needs_rehash:
+        db.execute("UPDATE users SET password_hash=? WHERE id=?", (hash_password(password), user[0]))
+        db.commit()
+    return user
+
+# Admin commands run one at a time on a background worker with its own
+# connection, and report back to the issuing socket as 'admin_progress'
+# events: 'queued', 'running', any number of 'progress', then 'done' or
+# 'failed'.
+class AdminJob:
+    ids = itertools.count(1)
+
+    def __init__(self, name, args, sid):
+        self.id = next(AdminJob.ids)
+        self.name = name
+        self.args = args
+        self.sid = sid
+
+    def report(self, status, **details):
+        socketio.emit('admin_progress', dict(details, job=self.id, command=self.name, status=status), to=self.sid)
+
+admin_jobs = queue.Queue()
+admin_worker = None
+admin_worker_lock = threading.Lock()
+
+def start_admin_worker():
+    global admin_worker
+    with admin_worker_lock:
+        if admin_worker is None:
+            admin_worker = socketio.start_background_task(run_admin_worker)
+
+def queue_admin_job(job):
+    if admin_worker is None:
+        start_admin_worker()
+    admin_jobs.put(job)
+    job.report('queued')
+
+def run_admin_worker():
+    db = connect_db()
+    while True:
+        job = admin_jobs.get()
+        job.report('running')
+        try:
+            result = ADMIN_COMMANDS[job.name][0](db, job, *job.args)
+        except ValueError as e:
+            db.rollback()
+            job.report('failed', error=str(e))
+        except Exception as e:
+            db.rollback()
+            app.logger.exception('Admin command %s failed', job.name)
+            job.report('failed', error=str(e))
+        else:
+            job.report('done', result=result)
+
+# Walks the whole id range in chunks, deleting the rows that match `where`.
+# With stop_at_kept the walk ends at the first chunk that keeps a row, for
+# conditions like age that only ever hold for a prefix of the ids.
+def delete_messages(db, job, where, params, stop_at_kept=False):
+    first, last = db.execute("SELECT min(id), max(id) FROM messages").fetchone()
+    deleted = 0
+    if first is None:
+        return deleted
+    chunk = app.config['ADMIN_CHUNK_SIZE']
+    for start in range(first, last + 1, chunk):
+        end = start + chunk
+        deleted += db.execute("DELETE FROM messages WHERE id>=? AND id<? AND " + where,
+                              (start, end) + params).rowcount
+        db.commit()
+        job.report('progress', done=min(end, last + 1) - first, total=last + 1 - first, deleted=deleted)
+        if stop_at_kept and db.execute("SELECT 1 FROM messages WHERE id>=? AND id<? LIMIT 1",
+                                       (start, end)).fetchone():
+            break
+        socketio.sleep(app.config['ADMIN_CHUNK_PAUSE'])
+    return deleted
+
+# The archive counterpart of delete_messages: rewrites every segment holding
+# rows that match drop, one segment per transaction, and drops the segments
+# left empty.
+def delete_archived(db, job, drop, stop_at_kept=False):
+    segments = [segment_id for (segment_id,) in db.execute("SELECT id FROM archive.segments ORDER BY id")]
+    deleted = 0
+    for done, segment_id in enumerate(segments, 1):
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT payload FROM archive.segments WHERE id=?", (segment_id,)).fetchone()
+            rows = json.loads(zlib.decompress(row[0])) if row else []
+            kept = [row for row in rows if not drop(row)]
+            if len(kept) < len(rows):
+                db.execute("DELETE FROM archive.segment_keys WHERE segment_id=?", (segment_id,))
+                db.execute("DELETE FROM archive.segments WHERE id=?", (segment_id,))
+                if kept:
+                    store_segment(db, kept, segment_id)
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+        deleted += len(rows) - len(kept)
+        job.report('progress', stage='archive', done=done, total=len(segments), deleted=deleted)
+        if stop_at_kept and kept:
+            break
+        socketio.sleep(app.config['ADMIN_CHUNK_PAUSE'])
+    with decoded_segments_lock:
+        decoded_segments.clear()
+    return deleted
+
+def reload_message_caches():
+    recent_history.clear()
+    load_unread()
+
+def database_size(db):
+    page_size = db.execute("PRAGMA page_size").fetchone()[0]
+    return db.execute("PRAGMA page_count").fetchone()[0] * page_size
+
+def admin_purge(db, job, date):
+    cutoff = int(datetime.datetime.fromisoformat(date).timestamp())
+    archived = delete_archived(db, job, lambda row: (row[4] or 0) < cutoff, stop_at_kept=True)
+    deleted = delete_messages(db, job, "coalesce(created, 0)<?", (cutoff,), stop_at_kept=True)
+    reload_message_caches()
+    return {'deleted': deleted, 'archived': archived}
+
+def admin_delete_user(db, job, username):
+    row = db.execute("SELECT id FROM users WHERE username=?", (username,)).fetchone()
+    deleted = delete_messages(db, job, "? IN (sender_id, receiver_id)", (row[0],)) if row else 0
+    archived = delete_archived(db, job, lambda row: username in (row[1], row[2]))
+    db.execute('''DELETE FROM read_marks WHERE username=?
+                  OR instr(char(31) || conversation || char(31), char(31) || ? || char(31))''',
+               (username, username))
+    removed = db.execute("DELETE FROM users WHERE username=?", (username,)).rowcount
+    db.commit()
+    for sid in list(presence.users.get(username, ())):
+        socketio.server.disconnect(sid)
+    user_directory.invalidate()
+    reload_message_caches()
+    return {'deleted': deleted, 'archived': archived, 'users': removed}
+
+def admin_vacuum(db, job):
+    before = database_size(db)
+    db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    db.execute("VACUUM")
+    return {'bytes_before': before, 'bytes_after': database_size(db)}
+
+def admin_analyze(db, job):
+    db.execute("ANALYZE")
+    db.execute("PRAGMA optimize")
+    if app.config['MESSAGE_SEARCH']:
+        db.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
+    db.commit()
+    return {}
+
+def admin_stats(db, job):
+    return {'database_bytes': database_size(db),
+            'free_pages': db.execute("PRAGMA freelist_count").fetchone()[0],
+            'writes': write_metrics(),
+            'history_cache': {'messages': recent_history.size, 'buffers': len(recent_history.buffers),
+                              'hits': recent_history.hits, 'misses': recent_history.misses},
+            'user_directory': user_directory.metrics(),
+            'online_users': presence.count(),
+            'sockets': len(presence.sockets),
+            'skipped_emits': presence.skipped_emits,
+            'emits': dict(emit_stats),
+            'unread_inboxes': len(unread.inboxes),
+            'rate_limits': {name: limiter.metrics() for name, limiter in rate_limiters.items()},
+            'admin_jobs_queued': admin_jobs.qsize()}
+
+ADMIN_COMMANDS = {
+    'purge': (admin_purge, 'purge YYYY-MM-DD'),
+    'delete_user': (admin_delete_user, 'delete_user USERNAME'),
+    'vacuum': (admin_vacuum, 'vacuum'),
+    'analyze': (admin_analyze, 'analyze'),
+    'stats': (admin_stats, 'stats'),
+}
+
+# Sessions are signed cookies that name their user. The user id they also
+# carry keeps a cookie from outliving its account, or from passing for a later
+# account registered under the same name. Returns the username, or None.
+# Deleting an account only invalidates the user directory of the process that
+# did it, so with a message queue between processes the id is read from the
+# database instead.
+def session_user():
+    username = session.get('username')
+    if username is None:
+        return None
+    c = get_db().cursor()
+    if app.config['MESSAGE_QUEUE']:
+        c.execute("SELECT id FROM users WHERE username=?", (username,))
+        row = c.fetchone()
+        user_id = row[0] if row else None
+    else:
+        user_id = user_directory.user_id(c, username)
+    if user_id is None or user_id != session.get('user_id'):
+        return None
+    return username
+
+@socketio.on('connect')
+def handle_connect(auth=None):
+    if not session_user():
+        return False
+    join_room(GLOBAL_ROOM)
+    join_room(user_room(session['username']))
+    if presence_sweeper is None:
+        start_presence_sweeper()
+    presence.add(session['username'], request.sid)
+
+@socketio.on('disconnect')
+def handle_disconnect(reason=None):
+    presence.remove(request.sid)
+
+@socketio.on('read')
+def handle_read(data):
+    if not session_user():
+        return {'error': 'Not logged in'}
+    if not isinstance(data, dict) or not isinstance(data.get('with'), str) or not isinstance(data.get('id'), int):
+        return {'error': 'Invalid read mark'}
+    mark_read(get_db(), session['username'], data['with'], data['id'])
+    return {}
+
+@socketio.on('admin_command')
+def handle_admin_command(data):
+    if not session_user() or not session.get('is_admin'):
+        return {'error': 'Admin only'}
+    command = data.get('command') if isinstance(data, dict) else None
+    words = command.split() if isinstance(command, str) else []
+    if not words:
+        return {'error': 'Empty command'}
+    name, args = words[0], words[1:]
+    if name not in ADMIN_COMMANDS:
+        return {'error': 'Unknown command, try: ' + ', '.join(sorted(ADMIN_COMMANDS))}
+    usage = ADMIN_COMMANDS[name][1]
+    if len(args) != len(usage.split()) - 1:
+        return {'error': 'Usage: ' + usage}
+
+    job = AdminJob(name, args, request.sid)
+    queue_admin_job(job)
+    return {'job': job.id}
+
+@socketio.on('heartbeat')
+def handle_heartbeat():
+    presence.touch(request.sid)
+
+@socketio.on('message')
+def handle_message(data):
+    if not session_user():
+        return {'error': 'Not logged in'}
+    if not isinstance(data, dict):
+        return {'error': 'Invalid message'}
+    presence.touch(request.sid)
+    wait = rate_limit_wait('MESSAGE', session['username'])
+    if wait:
+        return {'error': 'Too many messages', 'retry_after': wait}
+    message = data.get('message')
+    receiver = data.get('receiver') or 'all'
+    if not isinstance(message, str) or not isinstance(receiver, str) or message.strip() == '':
+        return {'error': 'Invalid message'}
+    if receiver != 'all' and not user_directory.exists(get_db().cursor(), receiver):
+        return {'error': 'Unknown receiver'}
+
+    sender = session['username']
+    try:
+        message_id = queue_message(sender, receiver, message).wait()
+    except sqlite3.Error:
+        return {'error': 'Message could not be stored'}
+
+    # The sending tab already shows the message; its other tabs and the
+    # receiver get it through their rooms.
+    emit_message({'id': message_id, 'username': sender, 'message': message,
+                  'admin': session.get('is_admin', False), 'receiver': receiver},
+                 skip_sid=request.sid)
+    return {'id': message_id}
+
+@socketio.on('sync')
+def handle_sync(data):
+    if not session_user():
+        return {'error': 'Not logged in'}
+    wait = rate_limit_wait('SYNC', session['username'])
+    if wait:
+        return {'error': 'Too many requests', 'retry_after': wait}
+    if not isinstance(data, dict) or not isinstance(data.get('after'), int):
+        return {'error': 'Invalid sync request'}
+    with_user = data.get('with')
+    if with_user is not None and not isinstance(with_user, str):
+        return {'error': 'Invalid sync request'}
+    c = get_db().cursor()
+    if with_user and not user_directory.exists(c, with_user):
+        return {'error': 'Unknown user'}
+
+    # One extra row tells the client whether to ask again.
+    limit = app.config['HISTORY_SYNC_LIMIT']
+    if with_user:
+        conversation = conversation_key(session['username'], with_user)
+        messages = recent_conversation_since(c, conversation, data['after'], limit + 1)
+    else:
+        messages = recent_inbox_since(c, session['username'], data['after'], limit + 1)
+    return {'messages': messages_json(messages[:limit]), 'more': len(messages) > limit}
+
+@app.before_request
+def start_request_timer():
+    g._request_start = time.perf_counter()
+
+@app.before_request
+def check_session_user():
+    if 'username' in session and not session_user():
+        session.clear()
+
+# Routes are labelled by their URL rule, not the path, so /mp/<username> is
+# one series however many users there are.
+@app.after_request
+def record_request(response):
+    start = g.pop('_request_start', None)
+    if start is not None and app.config['METRICS']:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        labels = (('route', route), ('method', request.method))
+        metrics.observe('chat_http_request_duration_seconds', labels, time.perf_counter() - start)
+        metrics.inc('chat_http_requests_total', labels + (('status', str(response.status_code)),))
+    return response
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     db = get_db()
@@ -58,336 +2891,184 @@ def index():
         return redirect(url_for('login'))
 
     if request.method == 'POST':
+        wait = rate_limit_wait('MESSAGE', session['username'])
+        if wait:
+            return too_many_requests(wait)
         message = request.form.get('message')
         sender = session['username']
-        receiver = request.form.get('receiver')
+        receiver = request.form.get('receiver') or 'all'
+        if receiver != 'all' and not user_directory.exists(c, receiver):
+            return "User not found", 404
 
         if message.strip() != '':
-            if receiver != 'all':
-                c.execute("INSERT INTO messages (sender, receiver, message) VALUES (?, ?, ?)", (sender, receiver, message))
-            else:
-                c.execute("INSERT INTO messages (sender, receiver, message) VALUES (?, ?, ?)", (sender, 'all', message))
-            db.commit()
-
-            socketio.emit('message', {'username': sender, 'message': message, 'admin': session.get('is_admin', False), 'receiver': receiver}, broadcast=True)
+            # Waiting first lets the fan-out carry the id clients sync from;
+            # with WRITE_DURABILITY 'async' the id is not known yet.
+            try:
+                message_id = wait_for_write(queue_message(sender, receiver, message))
+            except sqlite3.IntegrityError:
+                # An account deleted since the session was checked.
+                session.clear()
+                return redirect(url_for('login'))
+            emit_message({'id': message_id, 'username': sender, 'message': message,
+                          'admin': session.get('is_admin', False), 'receiver': receiver})
 
         return '', 204
     else:
-        c.execute("SELECT DISTINCT username FROM users")
-        users = [row[0] for row in c.fetchall()]
-        c.execute("SELECT sender, message FROM messages WHERE receiver='all' OR receiver=?", (session['username'],))
-        messages = c.fetchall()
-        return render_template_string("""
-            <!DOCTYPE html>
-            <html lang="fr">
-            <head>
-                <meta charset="UTF-8">
-                <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                <title>Chat</title>
-                <style>
-                    body {
-                        background-color: #282c34;
-                        font-family: 'Roboto', sans-serif;
-                        color: white;
-                        margin: 0;
-                        padding: 0;
-                        display: flex;
-                        justify-content: center;
-                        align-items: center;
-                        height: 100vh;
-                    }
-                    .header {
-                        width: 100%;
-                        display: flex;
-                        justify-content: space-between;
-                        align-items: center;
-                        padding: 10px 20px;
-                        background-color: #1c1e22;
-                        position: fixed;
-                        top: 0;
-                        z-index: 1000;
-                    }
-                    .header a {
-                        color: white;
-                        text-decoration: none;
-                        padding: 5px 10px;
-                        border: 1px solid transparent;
-                        border-radius: 5px;
-                    }
-                    .header a:hover {
-                        background-color: rgba(255, 255, 255, 0.1);
-                    }
-                    .chat-container {
-                        background-color: #3c4048;
-                        border-radius: 10px;
-                        box-shadow: 0px 0px 10px 0px rgba(0, 0, 0, 0.1);
-                        margin: 80px 20px;
-                        max-width: 800px;
-                        width: 100%;
-                        padding: 20px;
-                    }
-                    .message-input {
-                        border-radius: 5px;
-                        border: 1px solid #ccc;
-                        font-size: 16px;
-                        margin-bottom: 10px;
-                        padding: 10px;
-                        width: calc(100% - 20px);
-                    }
-                    .send-button {
-                        background-color: #4caf50;
-                        border: none;
-                        border-radius: 5px;
-                        color: white;
-                        cursor: pointer;
-                        font-size: 16px;
-                        padding: 10px 20px;
-                        margin-left: 10px;
-                    }
-                    .send-button:hover {
-                        background-color: #45a049;
-                    }
-                    .message {
-                        background-color: #525760;
-                        border-radius: 5px;
-                        margin-bottom: 5px;
-                        padding: 10px;
-                    }
-                    .username {
-                        font-weight: bold;
-                    }
-                    .content {
-                        margin-left: 5px;
-                    }
-                    .admin-message {
-                        color: #f00;
-                    }
-                    .admin-controls {
-                        position: fixed;
-                        top: 50px;
-                        right: 20px;
-                        padding: 10px
-                        background-color: #1c1e22;
-                        border-radius: 5px;
-                        box-shadow: 0 2px 5px rgba(0, 0, 0, 0.1);
-                        z-index: 1000;
-                    }
-                    .admin-command-input {
-                        border: none;
-                        border-radius: 3px;
-                        padding: 8px;
-                        margin-right: 5px;
-                        font-size: 14px;
-                        width: 200px;
-                    }
-                    .admin-command-button {
-                        background-color: #4caf50;
-                        border: none;
-                        border-radius: 3px;
-                        color: white;
-                        cursor: pointer;
-                        font-size: 14px;
-                        padding: 8px 12px;
-                    }
-                    .admin-command-button:hover {
-                        background-color: #45a049;
-                    }
-                    .delete-button {
-                        background-color: #ff0000;
-                        border: none;
-                        border-radius: 3px;
-                        color: white;
-                        cursor: pointer;
-                        font-size: 14px;
-                        padding: 8px 12px;
-                    }
-                    .delete-button:hover {
-                        background-color: #c00000;
-                    }
-                </style>
-            </head>
-            <body>
-                <div class="header">
-                    <div></div>
-                    <div>
-                        <span>Welcome, {{ session.username }}</span>
-                        <a href="/logout">Logout</a>
-                        <a href="/mp">MP</a>
-                    </div>
-                </div>
-                {% if session.get('is_admin') %}
-                <div class="admin-controls">
-                    <input id="admin-command-input" class="admin-command-input" placeholder="Enter command...">
-                    <button id="admin-command-button" class="admin-command-button" onclick="sendAdminCommand()">Send</button>
-                </div>
-                {% endif %}
-                <div class="chat-container">
-                    <div id="chat-messages" class="chat-messages">
-                        {% for sender, message in messages %}
-                        <div class="message">
-                            <span class="username">{{ sender }}: </span>
-                            <span class="content">{{ message }}</span>
-                        </div>
-                        {% endfor %}
-                    </div>
-                    <form id="message-form" method="post">
-                        <input id="receiver" type="hidden" name="receiver" value="all">
-                        <input id="message-input" class="message-input" name="message" placeholder="Type your message...">
-                        <button id="send-button" class="send-button" type="submit">Send</button>
-                    </form>
-                </div>
-
-                <script src="https://cdnjs.cloudflare.com/ajax/libs/socket.io/4.3.2/socket.io.js"></script>
-                <script>
-                    var socket = io.connect();
-
-                    document.getElementById('message-form').addEventListener('submit', function(event) {
-                        event.preventDefault();
-                        var messageInput = document.getElementById('message-input');
-                        var message = messageInput.value;
-                        var receiver = document.getElementById('receiver').value;
-                        messageInput.value = '';
-                        sendMessage(message, receiver);
-                    });
-
-                    function sendMessage(message, receiver) {
-                        if (message.trim() === '') {
-                            return;
-                        }
-
-                        var messageElement = document.createElement('div');
-                        messageElement.classList.add('message');
-                        var usernameSpan = document.createElement('span');
-                        usernameSpan.classList.add('username');
-                        usernameSpan.textContent = '{{ session.username }}: ';
-                        messageElement.appendChild(usernameSpan);
-                        var contentSpan = document.createElement('span');
-                        contentSpan.classList.add('content');
-                        contentSpan.textContent = message;
-                        messageElement.appendChild(contentSpan);
-                        document.getElementById('chat-messages').appendChild(messageElement);
-
-                        socket.emit('message', {'message': message, 'receiver': receiver});
-                    }
-
-                    socket.on('message', function(data) {
-                        var messageElement = document.createElement('div');
-                        messageElement.classList.add('message');
-                        var usernameSpan = document.createElement('span');
-                        usernameSpan.classList.add('username');
-                        usernameSpan.textContent = data.username + ': ';
-                        messageElement.appendChild(usernameSpan);
-                        var contentSpan = document.createElement('span');
-                        contentSpan.classList.add('content');
-                        contentSpan.textContent = data.message;
-                        messageElement.appendChild(contentSpan);
-                        document.getElementById('chat-messages').appendChild(messageElement);
-                    });
-
-                    function sendAdminCommand() {
-                        var commandInput = document.getElementById('admin-command-input');
-                        var command = commandInput.value;
-                        commandInput.value = '';
-                        socket.emit('admin_command', {'command': command});
-                    }
-                </script>
-            </body>
-            </html>
-        """, users=users, messages=messages)
+        messages = recent_inbox_page(c, session['username'])
+        unread_total = sum(count for sender, count, last_id in unread_conversations(c, session['username']))
+        if app.config['STREAM_PAGES']:
+            return stream_page('index', messages=messages, unread_total=unread_total)
+        return render_page('index', messages=messages, unread_total=unread_total)
+
+@app.route('/history')
+def history():
+    if 'username' not in session:
+        return redirect(url_for('login'))
+
+    before = request.args.get('before', type=int)
+    return history_json(fetch_inbox_page(get_db().cursor(), session['username'], before))
+
+@app.route('/search')
+def search():
+    if 'username' not in session:
+        return redirect(url_for('login'))
+    if not app.config['MESSAGE_SEARCH']:
+        return jsonify(error='Search is not available'), 503
+    wait = rate_limit_wait('SEARCH', session['username'])
+    if wait:
+        return too_many_requests(wait)
+
+    page = max(request.args.get('page', 0, type=int), 0)
+    limit = app.config['SEARCH_PAGE_SIZE']
+    # One extra row tells the client whether there is a next page.
+    rows = search_messages(get_db().cursor(), session['username'], request.args.get('q', ''),
+                           page * limit, limit + 1)
+    return jsonify(page=page, more=len(rows) > limit,
+                   results=[{'id': id, 'username': sender, 'receiver': receiver, 'message': message}
+                            for id, sender, receiver, message in rows[:limit]])
+
+@app.route('/users')
+def users():
+    if 'username' not in session:
+        return redirect(url_for('login'))
+
+    c = get_db().cursor()
+    after = request.args.get('after', '')
+    limit = min(request.args.get('limit', app.config['USER_PAGE_SIZE'], type=int), 1000)
+    page = user_directory.page(c, after, max(limit, 1))
+    return jsonify(count=user_directory.count(c), users=page)
+
+@app.route('/online')
+def online():
+    if 'username' not in session:
+        return redirect(url_for('login'))
+
+    return jsonify(count=presence.count(), users=presence.online(app.config['ONLINE_LIST_SIZE']))
+
+@app.route('/unread')
+def unread_messages():
+    if 'username' not in session:
+        return redirect(url_for('login'))
+
+    conversations = unread_conversations(get_db().cursor(), session['username'])
+    return jsonify(total=sum(count for sender, count, last_id in conversations),
+                   conversations=[{'username': sender, 'count': count, 'last_id': last_id}
+                                  for sender, count, last_id in conversations])
+
+METRIC_HELP = {
+    'chat_http_request_duration_seconds': ('histogram', 'Time spent handling HTTP requests.'),
+    'chat_http_requests_total': ('counter', 'HTTP requests handled.'),
+    'chat_sqlite_query_duration_seconds': ('histogram', 'Time spent in single SQLite calls.'),
+    'chat_sqlite_statement_seconds_total': ('counter', 'Time spent executing and fetching, per statement.'),
+    'chat_sqlite_statements_total': ('counter', 'Statements executed.'),
+    'chat_sqlite_slow_queries_total': ('counter', 'SQLite calls slower than SLOW_QUERY_SECONDS.'),
+    'chat_template_render_seconds': ('histogram', 'Time spent rendering page templates.'),
+    'chat_emit_duration_seconds': ('histogram', 'Time spent handing chat messages to Socket.IO.'),
+    'chat_emitted_messages_total': ('counter', 'Chat messages emitted.'),
+    'chat_emits_total': ('counter', 'Socket.IO emits of chat messages, single or batched.'),
+    'chat_skipped_emits_total': ('counter', 'Emits skipped because no receiver was online.'),
+    'chat_connected_sockets': ('gauge', 'Connected Socket.IO clients.'),
+    'chat_online_users': ('gauge', 'Users with at least one connected socket.'),
+    'chat_written_messages_total': ('counter', 'Messages stored by the batched writer.'),
+    'chat_write_queue_length': ('gauge', 'Messages waiting for the batched writer.'),
+    'chat_rate_limited_total': ('counter', 'Requests refused by a rate limiter.'),
+    'chat_history_cache_hits_total': ('counter', 'History pages served from memory.'),
+    'chat_history_cache_misses_total': ('counter', 'History pages read from the database.'),
+    'chat_idle_connections': ('gauge', 'SQLite connections waiting in the pool.'),
+}
+
+def metric_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def metric_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, metric_label_value(value)) for key, value in labels)
+
+# Renders everything in the Prometheus text exposition format.
+def metrics_text():
+    histograms, counters = metrics.snapshot()
+    for name, value in (('chat_emitted_messages_total', emit_stats['messages']),
+                        ('chat_emits_total', emit_stats['emits']),
+                        ('chat_skipped_emits_total', presence.skipped_emits),
+                        ('chat_connected_sockets', len(presence.sockets)),
+                        ('chat_online_users', presence.count()),
+                        ('chat_written_messages_total', write_stats['messages']),
+                        ('chat_write_queue_length', message_queue.qsize()),
+                        ('chat_history_cache_hits_total', recent_history.hits),
+                        ('chat_history_cache_misses_total', recent_history.misses),
+                        ('chat_idle_connections', db_pool.qsize())):
+        counters[(name, ())] = value
+    for limiter_name, limiter in rate_limiters.items():
+        counters[('chat_rate_limited_total', (('limiter', limiter_name),))] = limiter.rejected
+    series = {}
+    for name, labels, counts, total in histograms:
+        lines = series.setdefault(name, [])
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), counts):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (name, metric_labels(labels + (('le', bound),)), cumulative))
+        lines.append('%s_sum%s %r' % (name, metric_labels(labels), total))
+        lines.append('%s_count%s %d' % (name, metric_labels(labels), cumulative))
+    for (name, labels), value in counters.items():
+        series.setdefault(name, []).append('%s%s %r' % (name, metric_labels(labels), value))
+    output = []
+    for name in sorted(series):
+        kind, help = METRIC_HELP[name]
+        output.append('# HELP %s %s' % (name, help))
+        output.append('# TYPE %s %s' % (name, kind))
+        output.extend(series[name])
+    return '\n'.join(output) + '\n'
+
+@app.route('/metrics')
+def metrics_endpoint():
+    token = app.config['METRICS_TOKEN']
+    authorization = request.headers.get('Authorization', '')
+    if not (session.get('is_admin') or
+            token and hmac.compare_digest(authorization.encode(), ('Bearer ' + token).encode())):
+        return 'Forbidden', 403
+
+    return metrics_text(), {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     db = get_db()
-    c = db.cursor()
 
     if request.method == 'POST':
         username = request.form.get('username')
         password = request.form.get('password')
 
-        password_hash = hashlib.sha256(password.encode()).hexdigest()
-        c.execute("SELECT * FROM users WHERE username=? AND password_hash=?", (username, password_hash))
-        user = c.fetchone()
+        user = check_credentials(db, username, password)
 
         if user:
             session['username'] = username
-            session['is_admin'] = bool(user[3])
+            session['user_id'] = user[0]
+            session['is_admin'] = bool(user[2])
             return redirect(url_for('index'))
         else:
             return "Invalid credentials", 401
 
-    return render_template_string("""
-        <!DOCTYPE html>
-        <html lang="fr">
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>Login</title>
-            <style>
-                body {
-                    background-color: #282c34;
-                    font-family: 'Roboto', sans-serif;
-                    color: white;
-                    margin: 0;
-                    padding: 0;
-                    display: flex;
-                    justify-content: center;
-                    align-items: center;
-                    height: 100vh;
-                }
-                .login-container {
-                    background-color: #3c4048;
-                    border-radius: 10px;
-                    box-shadow: 0px 0px 10px 0px rgba(0, 0, 0, 0.1);
-                    max-width: 400px;
-                    width: 100%;
-                    padding: 20px;
-                    text-align: center;
-                }
-                .login-input {
-                    border-radius: 5px;
-                    border: 1px solid #ccc;
-                    font-size: 16px;
-                    margin-bottom: 10px;
-                    padding: 10px;
-                    width: calc(100% - 20px);
-                }
-                .login-button {
-                    background-color: #4caf50;
-                    border: none;
-                    border-radius: 5px;
-                    color: white;
-                    cursor: pointer;
-                    font-size: 16px;
-                    padding: 10px 20px;
-                    width: 100%;
-                }
-                .login-button:hover {
-                    background-color: #45a049;
-                }
-                .register-link {
-                    color: #61dafb;
-                    display: block;
-                    margin-top: 20px;
-                    text-decoration: none;
-                }
-                .register-link:hover {
-                    text-decoration: underline;
-                }
-            </style>
-        </head>
-        <body>
-            <div class="login-container">
-                <h2>Login</h2>
-                <form method="post">
-                    <input class="login-input" type="text" name="username" placeholder="Username" required>
-                    <input class="login-input" type="password" name="password" placeholder="Password" required>
-                    <button class="login-button" type="submit">Login</button>
-                </form>
-                <a class="register-link" href="/register">Register</a>
-            </div>
-        </body>
-        </html>
-    """)
+    return render_page('login')
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -398,94 +3079,26 @@ def register():
         username = request.form.get('username')
         password = request.form.get('password')
 
-        password_hash = hashlib.sha256(password.encode()).hexdigest()
+        password_hash = hash_password(password)
         try:
             c.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", (username, password_hash))
+            user_id = c.lastrowid
             db.commit()
         except sqlite3.IntegrityError:
             return "Username already exists", 400
+        user_directory.sync(c)
 
         session['username'] = username
+        session['user_id'] = user_id
         session['is_admin'] = False
         return redirect(url_for('index'))
 
-    return render_template_string("""
-        <!DOCTYPE html>
-        <html lang="fr">
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>Register</title>
-            <style>
-                body {
-                    background-color: #282c34;
-                    font-family: 'Roboto', sans-serif;
-                    color: white;
-                    margin: 0;
-                    padding: 0;
-                    display: flex;
-                    justify-content: center;
-                    align-items: center;
-                    height: 100vh;
-                }
-                .register-container {
-                    background-color: #3c4048;
-                    border-radius: 10px;
-                    box-shadow: 0px 0px 10px 0px rgba(0, 0, 0, 0.1);
-                    max-width: 400px;
-                    width: 100%;
-                    padding: 20px;
-                    text-align: center;
-                }
-                .register-input {
-                    border-radius: 5px;
-                    border: 1px solid #ccc;
-                    font-size: 16px;
-                    margin-bottom: 10px;
-                    padding: 10px;
-                    width: calc(100% - 20px);
-                }
-                .register-button {
-                    background-color: #4caf50;
-                    border: none;
-                    border-radius: 5px;
-                    color: white;
-                    cursor: pointer;
-                    font-size: 16px;
-                    padding: 10px 20px;
-                    width: 100%;
-                }
-                .register-button:hover {
-                    background-color: #45a049;
-                }
-                .login-link {
-                    color: #61dafb;
-                    display: block;
-                    margin-top: 20px;
-                    text-decoration: none;
-                }
-                .login-link:hover {
-                    text-decoration: underline;
-                }
-            </style>
-        </head>
-        <body>
-            <div class="register-container">
-                <h2>Register</h2>
-                <form method="post">
-                    <input class="register-input" type="text" name="username" placeholder="Username" required>
-                    <input class="register-input" type="password" name="password" placeholder="Password" required>
-                    <button class="register-button" type="submit">Register</button>
-                </form>
-                <a class="login-link" href="/login">Login</a>
-            </div>
-        </body>
-        </html>
-    """)
+    return render_page('register')
 
 @app.route('/logout')
 def logout():
     session.pop('username', None)
+    session.pop('user_id', None)
     session.pop('is_admin', None)
     return redirect(url_for('login'))
 
@@ -498,161 +3111,16 @@ def mp():
         return redirect(url_for('login'))
 
     if request.method == 'POST':
+        wait = rate_limit_wait('SEARCH', session['username'])
+        if wait:
+            return too_many_requests(wait)
         search_query = request.form.get('search_query')
-        c.execute("SELECT username FROM users")
-        users = [row[0] for row in c.fetchall()]
-
-        matched_users = get_close_matches(search_query, users, n=5, cutoff=0.8)
-        return render_template_string("""
-            <!DOCTYPE html>
-            <html lang="fr">
-            <head>
-                <meta charset="UTF-8">
-                <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                <title>Search Users</title>
-                <style>
-                    body {
-                        background-color: #282c34;
-                        font-family: 'Roboto', sans-serif;
-                        color: white;
-                        margin: 0;
-                        padding: 0;
-                        display: flex;
-                        justify-content: center;
-                        align-items: center;
-                        height: 100vh;
-                    }
-                    .search-container {
-                        background-color: #3c4048;
-                        border-radius: 10px;
-                        box-shadow: 0px 0px 10px 0px rgba(0, 0, 0, 0.1);
-                        max-width: 400px;
-                        width: 100%;
-                        padding: 20px;
-                        text-align: center;
-                    }
-                    .search-input {
-                        border-radius: 5px;
-                        border: 1px solid #ccc;
-                        font-size: 16px;
-                        margin-bottom: 10px;
-                        padding: 10px;
-                        width: calc(100% - 20px);
-                    }
-                    .search-button {
-                        background-color: #4caf50;
-                        border: none;
-                        border-radius: 5px;
-                        color: white;
-                        cursor: pointer;
-                        font-size: 16px;
-                        padding: 10px 20px;
-                        width: 100%;
-                    }
-                    .search-button:hover {
-                        background-color: #45a049;
-                    }
-                    .user-list {
-                        list-style: none;
-                        padding: 0;
-                        margin: 0;
-                    }
-                    .user-item {
-                        background-color: #525760;
-                        border-radius: 5px;
-                        margin-bottom: 10px;
-                        padding: 10px;
-                    }
-                    .user-link {
-                        color: white;
-                        text-decoration: none;
-                    }
-                    .user-link:hover {
-                        text-decoration: underline;
-                    }
-                </style>
-            </head>
-            <body>
-                <div class="search-container">
-                    <h2>Search Users</h2>
-                    <form method="post">
-                        <input class="search-input" type="text" name="search_query" placeholder="Search users..." required>
-                        <button class="search-button" type="submit">Search</button>
-                    </form>
-                    <ul class="user-list">
-                        {% for user in matched_users %}
-                        <li class="user-item">
-                            <a class="user-link" href="{{ url_for('mp_chat', username=user) }}">{{ user }}</a>
-                        </li>
-                        {% endfor %}
-                    </ul>
-                </div>
-            </body>
-            </html>
-        """, matched_users=matched_users)
-
-    return render_template_string("""
-        <!DOCTYPE html>
-        <html lang="fr">
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>Search Users</title>
-            <style>
-                body {
-                    background-color: #282c34;
-                    font-family: 'Roboto', sans-serif;
-                    color: white;
-                    margin: 0;
-                    padding: 0;
-                    display: flex;
-                    justify-content: center;
-                    align-items: center;
-                    height: 100vh;
-                }
-                .search-container {
-                    background-color: #3c4048;
-                    border-radius: 10px;
-                    box-shadow: 0px 0px 10px 0px rgba(0, 0, 0, 0.1);
-                    max-width: 400px;
-                    width: 100%;
-                    padding: 20px;
-                    text-align: center;
-                }
-                .search-input {
-                    border-radius: 5px;
-                    border: 1px solid #ccc;
-                    font-size: 16px;
-                    margin-bottom: 10px;
-                    padding: 10px;
-                    width: calc(100% - 20px);
-                }
-                .search-button {
-                    background-color: #4caf50;
-                    border: none;
-                    border-radius: 5px;
-                    color: white;
-                    cursor: pointer;
-                    font-size: 16px;
-                    padding: 10px 20px;
-                    width: 100%;
-                }
-                .search-button:hover {
-                    background-color: #45a049;
-                }
-            </style>
-        </head>
-        <body>
-            <div class="search-container">
-                <h2>Search Users</h2>
-                <form method="post">
-                    <input class="search-input" type="text" name="search_query" placeholder="Search users..." required>
-                    <button class="search-button" type="submit">Search</button>
-                </form>
-            </div>
-        </body>
-        </html>
-    """)
+        user_directory.refresh(c)
+        matched_users = [(user, presence.is_online(user))
+                         for user in user_index.search(search_query, n=5, cutoff=0.8)]
+        return render_page('mp_search', matched_users=matched_users)
+
+    return render_page('mp')
 
 @app.route('/mp/<username>', methods=['GET', 'POST'])
 def mp_chat(username):
@@ -661,155 +3129,181 @@ def mp_chat(username):
 
     if 'username' not in session:
         return redirect(url_for('login'))
+    if not user_directory.exists(c, username):
+        return "User not found", 404
 
     if request.method == 'POST':
+        wait = rate_limit_wait('MESSAGE', session['username'])
+        if wait:
+            return too_many_requests(wait)
         message = request.form.get('message')
         sender = session['username']
 
         if message.strip() != '':
-            c.execute("INSERT INTO messages (sender, receiver, message) VALUES (?, ?, ?)", (sender, username, message))
-            db.commit()
-
-            socketio.emit('message', {'username': sender, 'message': message, 'receiver': username}, broadcast=True)
+            try:
+                message_id = wait_for_write(queue_message(sender, username, message))
+            except sqlite3.IntegrityError:
+                session.clear()
+                return redirect(url_for('login'))
+            emit_message({'id': message_id, 'username': sender, 'message': message, 'receiver': username})
 
         return '', 204
     else:
-        c.execute("SELECT sender, message FROM messages WHERE (sender=? AND receiver=?) OR (sender=? AND receiver=?)",
-                  (session['username'], username, username, session['username']))
-        messages = c.fetchall()
-        return render_template_string("""
-            <!DOCTYPE html>
-            <html lang="fr">
-            <head>
-                <meta charset="UTF-8">
-                <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                <title>MP with {{ username }}</title>
-                <style>
-                    body {
-                        background-color: #282c34;
-                        font-family: 'Roboto', sans-serif;
-                        color: white;
-                        margin: 0;
-                        padding: 0;
-                        display: flex;
-                        justify-content: center;
-                        align-items: center;
-                        height: 100vh;
-                    }
-                    .chat-container {
-                        background-color: #3c4048;
-                        border-radius: 10px;
-                        box-shadow: 0px 0px 10px 0px rgba(0, 0, 0, 0.1);
-                        margin: 80px 20px;
-                        max-width: 800px;
-                        width: 100%;
-                        padding: 20px;
-                    }
-                    .message-input {
-                        border-radius: 5px;
-                        border: 1px solid #ccc;
-                        font-size: 16px;
-                        margin-bottom: 10px;
-                        padding: 10px;
-                        width: calc(100% - 20px);
-                    }
-                    .send-button {
-                        background-color: #4caf50;
-                        border: none;
-                        border-radius: 5px;
-                        color: white;
-                        cursor: pointer;
-                        font-size: 16px;
-                        padding: 10px 20px;
-                        margin-left: 10px;
-                    }
-                    .send-button:hover {
-                        background-color: #45a049;
-                    }
-                    .message {
-                        background-color: #525760;
-                        border-radius: 5px;
-                        margin-bottom: 5px;
-                        padding: 10px;
-                    }
-                    .username {
-                        font-weight: bold;
-                    }
-                    .content {
-                        margin-left: 5px;
-                    }
-                </style>
-            </head>
-            <body>
-                <div class="chat-container">
-                    <h2>Chat with {{ username }}</h2>
-                    <div id="chat-messages" class="chat-messages">
-                        {% for sender, message in messages %}
-                        <div class="message">
-                            <span class="username">{{ sender }}: </span>
-                            <span class="content">{{ message }}</span>
-                        </div>
-                        {% endfor %}
-                    </div>
-                    <form id="message-form" method="post">
-                        <input id="receiver" type="hidden" name="receiver" value="{{ username }}">
-                        <input id="message-input" class="message-input" name="message" placeholder="Type your message...">
-                        <button id="send-button" class="send-button" type="submit">Send</button>
-                    </form>
-                </div>
-
-                <script src="https://cdnjs.cloudflare.com/ajax/libs/socket.io/4.3.2/socket.io.js"></script>
-                <script>
-                    var socket = io.connect();
-
-                    document.getElementById('message-form').addEventListener('submit', function(event) {
-                        event.preventDefault();
-                        var messageInput = document.getElementById('message-input');
-                        var message = messageInput.value;
-                        var receiver = document.getElementById('receiver').value;
-                        messageInput.value = '';
-                        sendMessage(message, receiver);
-                    });
-
-                    function sendMessage(message, receiver) {
-                        if (message.trim() === '') {
-                            return;
-                        }
-
-                        var messageElement = document.createElement('div');
-                        messageElement.classList.add('message');
-                        var usernameSpan = document.createElement('span');
-                        usernameSpan.classList.add('username');
-                        usernameSpan.textContent = '{{ session.username }}: ';
-                        messageElement.appendChild(usernameSpan);
-                        var contentSpan = document.createElement('span');
-                        contentSpan.classList.add('content');
-                        contentSpan.textContent = message;
-                        messageElement.appendChild(contentSpan);
-                        document.getElementById('chat-messages').appendChild(messageElement);
-
-                        socket.emit('message', {'message': message, 'receiver': receiver});
-                    }
-
-                    socket.on('message', function(data) {
-                        if (data.receiver === '{{ username }}' || data.username === '{{ username }}' || data.receiver === '{{ session.username }}') {
-                            var messageElement = document.createElement('div');
-                            messageElement.classList.add('message');
-                            var usernameSpan = document.createElement('span');
-                            usernameSpan.classList.add('username');
-                            usernameSpan.textContent = data.username + ': ';
-                            messageElement.appendChild(usernameSpan);
-                            var contentSpan = document.createElement('span');
-                            contentSpan.classList.add('content');
-                            contentSpan.textContent = data.message;
-                            messageElement.appendChild(contentSpan);
-                            document.getElementById('chat-messages').appendChild(messageElement);
-                        }
-                    });
-                </script>
-            </body>
-            </html>
-        """, username=username, messages=messages)
+        conversation = conversation_key(session['username'], username)
+        if not app.config['STREAM_PAGES']:
+            messages = recent_conversation_page(c, conversation)
+            if messages:
+                mark_read(db, session['username'], username, messages[-1][0])
+            return render_page('mp_chat', username=username, messages=messages)
+        limit = app.config['HISTORY_PAGE_SIZE']
+        last_id = None
+        if not use_recent_history(limit):
+            c.execute('''SELECT max(id) FROM messages
+                         WHERE conversation_id=(SELECT id FROM conversations WHERE key=?)''', (conversation,))
+            last_id = c.fetchone()[0]
+        if last_id:
+            messages = iter_conversation_page(c, conversation, limit)
+        else:
+            # Served from the cache, or only archived rows are left: a short
+            # list either way.
+            messages = recent_conversation_page(c, conversation, limit)
+            last_id = messages[-1][0] if messages else None
+        if last_id:
+            mark_read(db, session['username'], username, last_id)
+        return stream_page('mp_chat', username=username, messages=messages)
+
+@app.route('/mp/<username>/history')
+def mp_history(username):
+    if 'username' not in session:
+        return redirect(url_for('login'))
+
+    before = request.args.get('before', type=int)
+    conversation = conversation_key(session['username'], username)
+    return history_json(fetch_conversation_page(get_db().cursor(), conversation, before))
+
+@app.route('/assets/<filename>')
+def asset(filename):
+    entry = static_assets.get(filename)
+    if entry is None:
+        return 'Not found', 404
+
+    content_type, digest, variants = entry
+    encoding = request.accept_encodings.best_match(
+        [encoding for encoding in ('br', 'gzip', 'identity') if encoding in variants]) or 'identity'
+    # Each encoding is a different representation and gets its own tag.
+    etag = digest if encoding == 'identity' else '%s-%s' % (digest, encoding)
+    headers = {'Cache-Control': 'public, max-age=%d, immutable' % app.config['ASSET_MAX_AGE'],
+               'ETag': '"%s"' % etag,
+               'Vary': 'Accept-Encoding'}
+    if request.if_none_match.contains(etag):
+        return '', 304, headers
+    headers['Content-Type'] = content_type
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return variants[encoding], headers
+
+# Stands in for a listening socket in a worker process: accept() receives the
+# connections the main process passes over a Unix socket pair.
+class HandoffListener:
+    family = socket.AF_INET
+
+    def __init__(self, channel, address):
+        self.channel = channel
+        self.address = address
+
+    def accept(self):
+        while True:
+            try:
+                message, fds, flags, peer = socket.recv_fds(self.channel, 1, 1)
+                break
+            except BlockingIOError:
+                eventlet.hubs.trampoline(self.channel.fileno(), read=True)
+        if not fds:
+            raise OSError('connection handoff channel closed')
+        connection = socket.socket(fileno=fds[0])
+        return connection, connection.getpeername()
+
+    def getsockname(self):
+        return self.address
+
+    def close(self):
+        self.channel.close()
+
+# Streamed pages, and Socket.IO frames, go out as several small writes. With
+# Nagle's algorithm a write that waits on the ACK of the one before stalls for
+# the client's delayed ACK, some 40 ms, so connections run with TCP_NODELAY.
+# Accepted sockets inherit it from the listener.
+def listen(host, port):
+    listener = socket.create_server((host, port), backlog=1024)
+    listener.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return listener
+
+def serve(listener):
+    if ASYNC_MODE == 'eventlet':
+        import eventlet.wsgi
+        eventlet.wsgi.server(listener, app, log_output=False)
+        return
+    from gevent import pywsgi
+    try:
+        from geventwebsocket.handler import WebSocketHandler
+    except ImportError:
+        # Websockets then go through simple-websocket.
+        pywsgi.WSGIServer(listener, app, log=None).serve_forever()
+    else:
+        pywsgi.WSGIServer(listener, app, handler_class=WebSocketHandler, log=None).serve_forever()
+
+def run_worker():
+    import eventlet.hubs
+    channel = socket.socket(fileno=run_args.worker_fd)
+    serve(HandoffListener(channel, (run_args.host, run_args.port)))
+
+# With --workers the main process only accepts connections and hands each one
+# to a worker picked by client address. Every request of a Socket.IO session,
+# long-polling included, therefore lands on the worker that holds it, and the
+# message queue carries emits between workers.
+def spawn_worker():
+    channel, worker_channel = socket.socketpair()
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                '--async-mode', ASYNC_MODE,
+                                '--host', run_args.host, '--port', str(run_args.port),
+                                '--message-queue', app.config['MESSAGE_QUEUE'],
+                                '--worker-fd', str(worker_channel.fileno())],
+                               pass_fds=[worker_channel.fileno()])
+    worker_channel.close()
+    return process, channel
+
+def run_master():
+    listener = listen(run_args.host, run_args.port)
+    workers = [spawn_worker() for i in range(run_args.workers)]
+    # Turn SIGTERM into an exception so the workers are stopped with us.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            connection, address = listener.accept()
+            slot = zlib.crc32(address[0].encode()) % len(workers)
+            process, channel = workers[slot]
+            try:
+                socket.send_fds(channel, [b'c'], [connection.fileno()])
+            except OSError:
+                app.logger.error('Worker %d exited with %s, restarting it', process.pid, process.poll())
+                channel.close()
+                workers[slot] = spawn_worker()
+            connection.close()
+    finally:
+        for process, channel in workers:
+            process.terminate()
+        for process, channel in workers:
+            process.wait()
 
 if __name__ == '__main__':
-    socketio.run(app, debug=True)
+    if run_args.worker_fd is not None:
+        start_retention_worker()
+        run_worker()
+    elif run_args.workers > 1:
+        run_master()
+    elif ASYNC_MODE in GREEN_MODES:
+        start_retention_worker()
+        serve(listen(run_args.host, run_args.port))
+    else:
+        start_retention_worker()
+        socketio.run(app, host=run_args.host, port=run_args.port, debug=True)